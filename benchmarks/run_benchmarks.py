@@ -0,0 +1,164 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import datetime
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+for subdir in ('cdump', 'pardump', 'inputs'):
+    sys.path.insert(0, os.path.join(BENCHDIR, '..', subdir))
+import synthetic
+
+
+"""
+PYTHON 3
+ABSTRACT: times and memory profiles reading and writing HYSPLIT files.
+
+   Synthetic cdump, pardump and CONTROL files are written (see synthetic.py) with the sizes given on
+   the command line, then each benchmark is run repeat times and timed with time.perf_counter.
+   Each benchmark is run once more with tracemalloc to find the peak memory allocated (numpy and
+   pandas allocations are included).
+   Results are written as JSON so that runs can be compared to find regressions.
+   A benchmark which raises an exception is recorded with the error message and the other benchmarks still run.
+
+   python run_benchmarks.py --nlat 400 --nlon 500 --nper 24 --npar 1000000 --output results.json
+   python run_benchmarks.py --baseline results.json     (prints the ratio of each time to the baseline)
+
+   FUNCTIONS
+   benchmarks - returns the list of benchmarks.
+   run - runs one benchmark.
+   main - command line interface.
+"""
+
+
+def benchmarks(args, tmpdir):
+    """returns list of (name, setup, func). setup() returns the argument passed to func (not timed)."""
+    from cdump import ModelBin
+    from pardump import Pardump
+    from hcontrol import HycsControl
+    cfile = os.path.join(tmpdir, 'cdump')
+    pfile = os.path.join(tmpdir, 'PARDUMP')
+    pout = os.path.join(tmpdir, 'PARINIT')
+    species = ['P%03d' % nnn for nnn in range(args.species)]
+    levels = [0] + list(range(100, 100 * args.levels, 100))
+    synthetic.write_cdump(cfile, nlat=args.nlat, nlon=args.nlon, levels=levels, species=species, nper=args.nper,
+                          sparsity=args.sparsity, nsources=args.sources)
+    synthetic.write_pardump(pfile, npar=args.npar, nrec=args.nrec, npoll=args.species)
+    synthetic.write_control('CONTROL.in', working_directory=tmpdir + '/', nsources=args.sources, nspecies=args.species,
+                            nlevels=args.levels)
+    rng = np.random.default_rng(0)
+
+    def particles():
+        return (args.npar, np.ones(args.npar), rng.uniform(-130, -110, args.npar), rng.uniform(30, 50, args.npar),
+                rng.uniform(0, 5000, args.npar), 1, datetime.datetime(2016, 5, 1))
+
+    def control():
+        control = HycsControl(fname='CONTROL.in', working_directory=tmpdir)
+        control.read()
+        control.rename('CONTROL.out', working_directory=tmpdir)
+        return control
+
+    def concentration(model):
+        for pdate in model.pdates:
+            model.get_concentration(pdate[0], grid=1)
+
+    return [('cdump_readfile', lambda: cfile, lambda fname: ModelBin(fname, cdir='')),
+            ('cdump_readcube', lambda: cfile, lambda fname: ModelBin(fname, cdir='', storage='cube')),
+            ('cdump_readcompact', lambda: cfile, lambda fname: ModelBin(fname, cdir='', storage='compact')),
+            ('cdump_get_concentration', lambda: ModelBin(cfile, cdir=''), concentration),
+            ('pardump_read', lambda: Pardump(pfile), lambda pdump: pdump.read(verbose=0)),
+            ('pardump_write', particles, lambda particles: Pardump(pout).write(*particles)),
+            ('control_read', lambda: HycsControl(fname='CONTROL.in', working_directory=tmpdir),
+             lambda control: control.read()),
+            ('control_write', control, lambda control: control.write(verbose=False)),
+           ]
+
+
+def run(name, setup, func, repeat):
+    """runs func(setup()) repeat times and once more with tracemalloc.
+       Output printed by func is discarded.
+       returns dictionary with name, times (seconds), min, mean, peak_bytes and error (None if no exception)."""
+    result = {'name': name, 'times': [], 'min': None, 'mean': None, 'peak_bytes': None, 'error': None}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for nnn in range(repeat):
+                arg = setup()
+                start = time.perf_counter()
+                func(arg)
+                result['times'].append(time.perf_counter() - start)
+            arg = setup()
+            tracemalloc.start()
+            func(arg)
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+    except Exception as err:
+        result['error'] = '{0}: {1}'.format(type(err).__name__, err)
+    finally:
+        if tracemalloc.is_tracing():
+           tracemalloc.stop()
+    if result['times']:
+       result['min'] = min(result['times'])
+       result['mean'] = sum(result['times']) / len(result['times'])
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmarks for reading and writing HYSPLIT files')
+    parser.add_argument('--nlat', type=int, default=200, help='number of latitudes of the cdump grid')
+    parser.add_argument('--nlon', type=int, default=300, help='number of longitudes of the cdump grid')
+    parser.add_argument('--nper', type=int, default=12, help='number of sampling periods in the cdump file')
+    parser.add_argument('--levels', type=int, default=3, help='number of levels (including the deposition level 0)')
+    parser.add_argument('--species', type=int, default=2, help='number of pollutants')
+    parser.add_argument('--sparsity', type=float, default=0.1, help='fraction of grid cells with nonzero concentration')
+    parser.add_argument('--sources', type=int, default=1, help='number of release locations')
+    parser.add_argument('--npar', type=int, default=100000, help='number of particles in each pardump time record')
+    parser.add_argument('--nrec', type=int, default=6, help='number of pardump time records')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of each benchmark')
+    parser.add_argument('--only', nargs='*', help='names of the benchmarks to run (default all)')
+    parser.add_argument('--output', help='file to write JSON results to (default stdout)')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare to')
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix='hysplit_bench_')
+    try:
+        results = []
+        for name, setup, func in benchmarks(args, tmpdir):
+            if args.only and name not in args.only:
+               continue
+            results.append(run(name, setup, func, args.repeat))
+        sizes = dict((fname, os.path.getsize(os.path.join(tmpdir, fname))) for fname in ('cdump', 'PARDUMP', 'CONTROL.in'))
+    finally:
+        shutil.rmtree(tmpdir)
+    report = {'date': datetime.datetime.now().isoformat(),
+              'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+              'platform': platform.platform(),
+              'params': vars(args), 'file_bytes': sizes, 'results': results}
+    text = json.dumps(report, indent=1)
+    if args.output:
+       with open(args.output, 'w') as fid:
+           fid.write(text)
+    else:
+       print(text)
+    if args.baseline:
+       with open(args.baseline) as fid:
+           baseline = dict((result['name'], result) for result in json.load(fid)['results'])
+       for result in results:
+           base = baseline.get(result['name'])
+           if base is None or base['min'] is None or result['min'] is None:
+              continue
+           print('{0:28s} {1:10.4f}s  baseline {2:10.4f}s  ratio {3:6.2f}'.format(
+                 result['name'], result['min'], base['min'], result['min'] / base['min']), file=sys.stderr)
+    return report
+
+
+if __name__ == '__main__':
+    main()
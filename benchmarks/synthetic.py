@@ -0,0 +1,151 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import os
+import sys
+import datetime
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'inputs'))
+
+
+"""
+PYTHON 3
+ABSTRACT: writes synthetic HYSPLIT files of any size for the benchmarks.
+
+   The binary files are written straight from numpy structured arrays, without the classes
+   which are benchmarked, so the same files can be used to compare versions of the code.
+
+   FUNCTIONS
+   write_cdump - writes a packed binary cdump (concentration) file.
+   write_pardump - writes a binary pardump (particle position) file.
+   write_control - writes a CONTROL file with HycsControl.
+"""
+
+
+def _record(payload):
+    """returns bytes of a fortran unformatted sequential record (4 byte length markers before and after)"""
+    marker = np.array([len(payload)], dtype='>i4').tobytes()
+    return marker + payload + marker
+
+
+def write_cdump(fname, nlat=100, nlon=150, levels=(0, 100, 500), species=('PM25',), nper=6, sparsity=0.1,
+                nsources=1, start=datetime.datetime(2016, 5, 1, 0), seed=0):
+    """writes a packed binary cdump file.
+       nlat, nlon - size of the concentration grid (0.1 degree spacing).
+       levels - list of level heights. species - list of pollutant identifiers (up to 4 characters).
+       nper - number of one hour sampling periods.
+       sparsity - fraction of grid cells with a nonzero concentration in each record.
+       nsources - number of release locations.
+       returns the number of bytes written."""
+    rng = np.random.default_rng(seed)
+    ncell = nlat * nlon
+    nnz = int(round(sparsity * ncell))
+    rec8b = np.dtype([('indx', '>i2'), ('jndx', '>i2'), ('conc', '>f4')])
+    nbytes = 0
+    with open(fname, 'wb') as fid:
+        header = _record(b'SYNT' + np.array([start.year % 100, start.month, start.day, start.hour, 0,
+                                              nsources, 1], dtype='>i4').tobytes())
+        for nnn in range(nsources):
+            header += _record(np.array([start.year % 100, start.month, start.day, start.hour], dtype='>i4').tobytes() +
+                              np.array([40.0 + 0.01 * nnn, -120.0, 500.0], dtype='>f4').tobytes() +
+                              np.array([0], dtype='>i4').tobytes())
+        header += _record(np.array([nlat, nlon], dtype='>i4').tobytes() +
+                          np.array([0.1, 0.1, 30.0, -130.0], dtype='>f4').tobytes())
+        header += _record(np.array([len(levels)] + list(levels), dtype='>i4').tobytes())
+        header += _record(np.array([len(species)], dtype='>i4').tobytes() +
+                          b''.join(sp.encode('UTF-8').ljust(4)[:4] for sp in species))
+        fid.write(header)
+        nbytes += len(header)
+        for ttt in range(nper):
+            pdates = [start + datetime.timedelta(hours=ttt), start + datetime.timedelta(hours=ttt + 1)]
+            period = b''.join(_record(np.array([pdate.year % 100, pdate.month, pdate.day, pdate.hour, 0, ttt],
+                                               dtype='>i4').tobytes()) for pdate in pdates)
+            for lev in levels:
+                for sp in species:
+                    cells = np.sort(rng.choice(ncell, size=nnz, replace=False))
+                    conc = np.zeros(nnz, dtype=rec8b)
+                    conc['jndx'] = cells // nlon + 1
+                    conc['indx'] = cells % nlon + 1
+                    conc['conc'] = rng.lognormal(size=nnz)
+                    period += _record(sp.encode('UTF-8').ljust(4)[:4] + np.array([lev, nnz], dtype='>i4').tobytes() +
+                                      conc.tobytes())
+            fid.write(period)
+            nbytes += len(period)
+    return nbytes
+
+
+def write_pardump(fname, npar=10000, nrec=6, npoll=1, start=datetime.datetime(2016, 5, 1, 0), seed=0):
+    """writes a binary pardump file with nrec time records (one per hour) of npar particles.
+       Each particle has a mass for each of npoll pollutants (the mass record has npoll values) and
+       the pollutant index (poll) of the particles cycles through the pollutants.
+       A tenth of the particles in the first record have not been released yet (lat = 0).
+       returns the number of bytes written."""
+    rng = np.random.default_rng(seed)
+    hdr_dt = np.dtype([('padding', '>i4'), ('parnum', '>i4'), ('pollnum', '>i4'), ('year', '>i4'),
+                       ('month', '>i4'), ('day', '>i4'), ('hour', '>i4'), ('minute', '>i4')])
+    pardt = np.dtype([('p1', '>i4'), ('p2', '>i4'), ('pmass', '>f4', (npoll,)), ('p3a', '>i4'), ('p3b', '>i4'),
+                      ('lat', '>f4'), ('lon', '>f4'), ('ht', '>f4'), ('su', '>f4'), ('sv', '>f4'), ('sx', '>f4'),
+                      ('p4a', '>i4'), ('p4b', '>i4'), ('age', '>i4'), ('dist', '>i4'), ('poll', '>i4'),
+                      ('mgrid', '>i4'), ('sorti', '>i4')])
+    lat = 40.0 + rng.normal(scale=0.5, size=npar)
+    lon = -120.0 + rng.normal(scale=0.5, size=npar)
+    ht = rng.uniform(0, 5000, size=npar)
+    nbytes = 0
+    with open(fname, 'wb') as fid:
+        for ttt in range(nrec):
+            pdate = start + datetime.timedelta(hours=ttt)
+            hdr = np.zeros(1, dtype=hdr_dt)
+            hdr['padding'] = 28
+            hdr['parnum'] = npar
+            hdr['pollnum'] = npoll
+            hdr['year'] = pdate.year % 100
+            hdr['month'] = pdate.month
+            hdr['day'] = pdate.day
+            hdr['hour'] = pdate.hour
+            par = np.zeros(npar, dtype=pardt)
+            par['p1'] = 20
+            par['p1'][0] = 28
+            par['p2'] = 4 * npoll
+            par['p3a'] = 4 * npoll
+            par['p3b'] = 24
+            par['p4a'] = 24
+            par['p4b'] = 20
+            lat += rng.normal(scale=0.01, size=npar)
+            lon += rng.normal(scale=0.01, size=npar)
+            par['pmass'] = 1.0
+            par['lat'] = lat
+            par['lon'] = lon
+            par['ht'] = ht
+            par['age'] = ttt * 60
+            par['poll'] = np.arange(npar) % npoll + 1
+            par['mgrid'] = 1
+            par['sorti'] = np.arange(1, npar + 1)
+            if ttt == 0:
+               par['lat'][:npar // 10] = 0
+            fid.write(hdr.tobytes())
+            fid.write(par.tobytes())
+            fid.write(np.array([20], dtype='>i4').tobytes())
+            nbytes += hdr.nbytes + par.nbytes + 4
+    return nbytes
+
+
+def write_control(fname, working_directory='./', nsources=1, nspecies=1, ngrids=1, nlevels=3, nmet=1,
+                  start=datetime.datetime(2016, 5, 1, 0)):
+    """writes a CONTROL file with HycsControl. returns the HycsControl object."""
+    from hcontrol import HycsControl, Species, ConcGrid
+    control = HycsControl(fname=fname, working_directory=working_directory)
+    control.add_sdate(start)
+    for nnn in range(nsources):
+        control.add_location(latlon=(40.0 + 0.01 * nnn, -120.0), alt=500.0)
+    control.add_duration(24)
+    control.add_vmotion(0)
+    control.add_ztop(25000.0)
+    for nnn in range(nmet):
+        control.add_metfile('/met/', 'met.%03d' % nnn)
+    for nnn in range(nspecies):
+        control.add_species(Species('P%03d' % nnn, psize=1.0, duration=1.0))
+    for nnn in range(ngrids):
+        control.add_cgrid(ConcGrid('grid', levels=list(range(0, 100 * nlevels, 100)), centerlat=40.0, centerlon=-120.0,
+                                   latdiff=0.1, londiff=0.1, latspan=10.0, lonspan=15.0, outfile='cdump.%d' % nnn,
+                                   interval=(1, 0)))
+    control.write(verbose=False)
+    return control
@@ -1,8 +1,12 @@
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import os
+import time
+import hashlib
+import tempfile
+import multiprocessing
 import numpy as np
 import datetime
 import pandas as pd
-from pylab import matrix
 
 
 """
@@ -12,6 +16,10 @@ ABSTRACT: classes and functions for creating HYSPLIT control and setup files.
 
    CLASSES
    ModelBin class for parsing binary HYSPLIT CDUMP file
+   CdumpMap class which memory maps a binary HYSPLIT CDUMP file and finds the records in it.
+   CdumpPeriod class representing the concentrations for one sampling period.
+   CdumpCache class for an on disk cache of decoded cdump files.
+   CachedMap class which gives the records of a CdumpCache entry in the same way as CdumpMap.
 
 
    CHANGES for PYTHON 3
@@ -26,29 +34,86 @@ class ModelBin(object):
   """represents a binary cdump (concentration) output file from HYSPLIT
      methods:
      get_concentration - returns concentrations or mass loadings as either list or array.
+     get_concentration_cube - returns mass loading or concentration for many sampling periods as a 3d array
      get_latlon - returns latitude longitude positions as either list or array
+     _latlon_axes - returns latitude and longitude of the grid as 1d arrays
+     _latlon_grid - returns cached (read only) 2d latitude and longitude arrays
      define_struct - static method storing structure of cdump binary file in numpy dtypes.
      __init__
      _col_name - creates concentration column name describing pollutant and level
      _mcol_name- creates mass loading column name describing pollutant and level
      thicknesses - calculates self.depth - list of thicknesses corresponding to each top height in self.level
      _readfile - opens and reads contents of cdump file into pandas dataframe
+     _readcompact - opens and reads contents of cdump file into pandas dataframe with compact data types
+     memory_usage - returns number of bytes used by the file and the data read from it
+     _readcube - opens and reads contents of cdump file into a numpy array (self.cube)
+     _cube_frame - creates the pandas dataframe (self.concframe) from self.cube
+     _header - copies header information from a CdumpMap object
+     _test_dates - tests whether a sampling period is within drange
+     scan - reads only the headers and builds an index of the concentration records (summary of what is in the file)
+     read_period - returns the concentration records for one sampling period
+     iter_periods - generator which yields the concentrations one sampling period at a time (CdumpPeriod objects)
+     poll - reads the sampling periods added to the file since the last call
+     follow - generator which yields sampling periods as they are written to the file (follow mode)
+     _open - memory maps the file and reads the header
+     _axes - returns the levels and pollutants which are read from the file
+     _select - selects the rows of the record index for the levels and pollutants which are read
+     write - writes a cdump file from self.cube or self.concframe
+     _new - sets empty header attributes for creating a new cdump file
+     add_conc - adds concentrations from other cdump files (read in parallel)
+     _grid - returns tuple describing the concentration grid
+     _frame_cube - creates self.cube from self.concframe
+     _set_cube - sets self.cube from a dictionary of 2d arrays
+     _level_weights - returns the (level, pollutant) weights summed by get_concentration_cube
+     _records - returns the concentration records for one sampling period
+     get_sparse - returns scipy.sparse matrices of concentration for each pollutant and level
+     get_sparse_concentration - returns scipy.sparse matrix of mass loading or concentration
+     xtract_point - returns concentrations at a list of lat-lon points
+     _point_index - returns grid indices and weights for a list of lat-lon points
+     _cube_names - sets species and conc_names from self.cube
+     window_mean - returns ModelBin with time averages over a list of windows
+     rolling_mean - returns ModelBin with rolling averages (e.g. 8 or 24 hour)
+     daily_mean - returns ModelBin with daily averages
+     daily_max - returns ModelBin with daily maximum concentrations
+     running_total - returns ModelBin with time integrated concentrations
+     running_max - returns ModelBin with maximum concentrations to date
+     _aggregate - creates a ModelBin from sampling periods and a concentration array
+     _period_minutes, _cumulative, _integral - time integral of the concentrations used by window_mean
+     get_area - returns the area of each grid cell
+     coarsen - returns ModelBin on a grid coarser by an integer factor
+     regrid - returns ModelBin on another grid (conservative regridding)
+     _regridded - creates a ModelBin on a new grid
 
-     not working
-     add_conc (method to add concentration grids together)
-     xtract_point (method to extract concentration at lat-lon point
      ##It isn't clear if we want to keep the restriction that the sample stop must be less than drange[1]. 
-     ##TO DO - be able to just get a summary of what is in the file - sample output times and so forth
-     ##        without reading in the whole file?
-     ##TO DO - method to write a cdump file. 
-     ##TO DO - write add_conc method to add concentration grids together.
   """
 
-  def __init__(self, filename, cdir='./', drange=[], missing=(), century=0, verbose=False, readwrite='r'):
+  def __init__(self, filename, cdir='./', drange=[], missing=(), century=0, verbose=False, readwrite='r', sidecar=False,
+               storage='frame', species=None, levels=None, cache=None):
      """
        drange should be a list of two datetime objects. 
         The read method will store data from the cdump file for which the sample start is greater thand drange[0] and less than drange[1] 
         for which the sample stop is less than drange[1]. 
+       readwrite - if 'r' then reads the whole file.
+                   if 's' then only scans the file for a summary of what is in it (see scan method).
+                   if 'w' then nothing is read. Set the header attributes and self.cube or self.concframe
+                   and use the write method to create a cdump file (see _new).
+                   if '' then nothing is read and the file does not need to exist yet. Use iter_periods to read
+                   the file one sampling period at a time, or poll and follow for a file which is still being
+                   written. self.pdates is [], self.sdate and self.edate are None and self.dataflag is False
+                   until poll finds sampling periods.
+       sidecar - if True and readwrite='s' then the index built by the scan is saved to / loaded from a sidecar file.
+       storage - if 'frame' then the concentrations are stored in the pandas dataframe self.concframe.
+                 if 'cube' then the concentrations are stored in self.cube, a float32 array with shape
+                 (time, level, pollutant, nlat, nlon) (see _readcube). self.concframe is then created from
+                 the cube the first time it is used.
+                 if 'compact' then self.concframe is created with float32 concentrations, int16 indices and
+                 categorical dates, which uses less memory (see _readcompact and memory_usage).
+       species - list of pollutant identifiers to read. if None then all pollutants are read.
+       levels - list of levels (top height of level as stored in cdump file) to read. if None then all levels are read.
+                The concentration records of other pollutants and levels are skipped over without being read.
+       cache - CdumpCache object or name of a cache directory. if not None and readwrite='r' then the
+               decoded records are loaded from the cache if the file is in it and the concentrations are
+               stored as asked for by storage. Otherwise the file is read and its records are stored in the cache.
         
      """
      ##It isn't clear if we want to keep the restriction that the sample stop must be less than drange[1]. 
@@ -67,17 +132,362 @@ class ModelBin(object):
      #self.sdate       #first sampling time start dates
      #self.edate       #last sampling time end dates
      #self.levels      #list of levels  (top height of level as stored in cdump file)
-     if readwrite == 'r': 
+     self._concframe = None
+     self._latlon = None      #cached latitude, longitude axes (see _latlon_axes)
+     self._latlon2d = None    #cached 2d latitude, longitude arrays (see _latlon_grid)
+     self._cachemap = None    #CachedMap used by _open instead of the file (see CdumpCache.load)
+     self.cube = None    #numpy array (time, level, pollutant, nlat, nlon) if storage='cube'
+     self.cmap = None    #CdumpMap object for the file
+     self.select_species = species  #pollutants to read. None for all.
+     self.select_levels = levels    #levels to read. None for all.
+     self._pastdrange = False       #set by poll when a sampling period after drange is found.
+     if isinstance(cache, str):
+         cache = CdumpCache(cache)
+     cached = False
+     if readwrite == 'r' and cache is not None:
+         cachekey = cache.key(self)   #before reading since reading sets self.century
+         cached = cache.load(self, cachekey)
+     if readwrite == 'r' and storage == 'cube':
+         self.dataflag = self._readcube()
+         if self.dataflag:
+             self.thicknesses()
+     elif readwrite == 'r' and storage == 'compact':
+         self.dataflag = self._readcompact()
+         if self.dataflag:
+             self.thicknesses()
+     elif readwrite == 'r': 
          self.dataflag = self._readfile(cdir+filename, drange, verbose, century)
          if self.dataflag:
              self.thicknesses() 
              #self.get_concentration()
              #self.get_latlon()
+     elif readwrite == 's':
+         self.dataflag = self.scan(sidecar=sidecar)
+         if self.dataflag:
+             self.thicknesses()
+     elif readwrite == 'w':
+         self._new()
+     elif readwrite == '':
+         self.pdates = []
+         self.sdate = None
+         self.edate = None
+         self.dataflag = False
+     if readwrite == 'r' and cache is not None and not cached and self.cmap is not None:
+         cache.store(self, cachekey)
      
-  def add_conc(self, concframe):
-      ##TO DO - method to add concentration grids together.
-      #self.concframe = concframe
-      return -1 
+  @property
+  def concframe(self):
+      """pandas Data frame with lat, lon and concentration for each level and pollutant.
+         if the data is stored in self.cube then the dataframe is created from it the first time it is used."""
+      if self._concframe is None and self.cube is not None:
+         self._concframe = self._cube_frame()
+      return self._concframe
+
+  @concframe.setter
+  def concframe(self, concframe):
+      self._concframe = concframe
+
+  def add_conc(self, others, processes=None, verbose=False):
+      """adds the concentrations from other cdump files to the concentrations in this one.
+         others - list of ModelBin objects and / or cdump file names.
+         processes - number of worker processes used to read the files. if None uses the number of cpus.
+                     if 1 the files are read in this process.
+         The files are read with the same drange, species and levels as this one.
+         Concentrations are matched by sampling period, pollutant and level. The sampling periods,
+         levels and pollutants of the result are the union of those in all the files.
+         All files must have the same concentration grid.
+         The sum is stored in self.cube (float32) and self.concframe is created from it when next used.
+         returns False if the grids do not match (nothing is changed) else returns True."""
+      grid = self._grid()
+      models = [other for other in others if isinstance(other, ModelBin)]
+      fnames = [other for other in others if not isinstance(other, ModelBin)]
+      for other in models:
+          if other._grid() != grid:
+             print('warning: ModelBin add_conc - concentration grid of ' + other.filename + ' does not match')
+             return False
+      total = {}
+      for model in [self] + models:
+          if model.cube is None and model.concframe is not None:
+             model._frame_cube()
+          if model.cube is not None:
+             _add_cube(total, _cube_summary(model))
+          else:
+             _add_records(total, model)     #scanned file (readwrite='s'). records are read from the file.
+      args = [(fname, self.drange, self.select_species, self.select_levels) for fname in fnames]
+      if processes == 1 or len(args) <= 1:
+         results = map(_read_cube, args)
+         pool = None
+      else:
+         pool = multiprocessing.Pool(processes)
+         results = pool.imap_unordered(_read_cube, args)
+      try:
+         for summary in results:
+             if summary['grid'] != grid:
+                print('warning: ModelBin add_conc - concentration grid of ' + summary['filename'] + ' does not match')
+                return False
+             if verbose:
+                print('adding', summary['filename'])
+             if summary['cube'] is not None:
+                _add_cube(total, summary)
+      finally:
+         if pool is not None:
+            pool.terminate()
+      self._set_cube(total)
+      return True
+
+  def _grid(self):
+      """returns tuple describing the concentration grid (nlat, nlon, dlat, dlon, llcrnr_lat, llcrnr_lon)"""
+      return (int(self.nlat), int(self.nlon), float(self.dlat), float(self.dlon),
+              float(self.llcrnr_lat), float(self.llcrnr_lon))
+
+  def _frame_cube(self):
+      """creates self.cube from self.concframe."""
+      levels, pollutants = self._axes()
+      kindex = dict((lev, k) for k, lev in enumerate(levels))
+      pindex = dict((poll, p) for p, poll in enumerate(pollutants))
+      cube = np.zeros((len(self.pdates), len(levels), len(pollutants), self.nlat, self.nlon), dtype=np.float32)
+      for t, (pdate1, pdate2, records) in enumerate(self._period_records()):
+          for (poll, lev), (indx, jndx, conc) in records.items():
+              cube[t, kindex[lev], pindex[poll], jndx - 1, indx - 1] = conc
+      self.cube = cube
+
+  def _set_cube(self, total):
+      """sets self.cube and the attributes which describe it from a dictionary.
+         key is (sample start, sample stop, poll, lev). value is 2d array (nlat, nlon).
+         self.levels and self.pollutants keep all the levels and pollutants of the file (so the level
+         thicknesses do not change) and levels and pollutants in total which are not in them are added.
+         The axes of the cube are those returned by _axes. The species and levels selections are kept
+         and extended with any levels and pollutants in total which are not in them."""
+      self.pdates = sorted(set((key[0], key[1]) for key in total))
+      klevels = sorted(set(key[3] for key in total))
+      self.levels = np.array(sorted(set(int(lev) for lev in self.levels) | set(klevels)))
+      kpollutants = []
+      for key in total:
+          if key[2] not in kpollutants:
+             kpollutants.append(key[2])
+      self.pollutants = list(self.pollutants) + [poll for poll in kpollutants if poll not in self.pollutants]
+      if self.select_levels is not None:
+         self.select_levels = list(self.select_levels) + [lev for lev in klevels if lev not in self.select_levels]
+      if self.select_species is not None:
+         self.select_species = list(self.select_species) + [poll for poll in kpollutants
+                                                            if poll not in self.select_species]
+      levels, pollutants = self._axes()
+      self.cube = np.zeros((len(self.pdates), len(levels), len(pollutants), self.nlat, self.nlon),
+                           dtype=np.float32)
+      tindex = dict((pdate, t) for t, pdate in enumerate(self.pdates))
+      kindex = dict((lev, k) for k, lev in enumerate(levels))
+      pindex = dict((poll, p) for p, poll in enumerate(pollutants))
+      for (pdate1, pdate2, poll, lev), conc2d in total.items():
+          self.cube[tindex[(pdate1, pdate2)], kindex[lev], pindex[poll]] = conc2d
+      self._cube_names()
+
+  def _cube_names(self):
+      """sets species, conc_names, sdate, edate and dataflag from self.cube and self.pdates."""
+      levels, pollutants = self._axes()
+      self.species = []
+      self.conc_names = []
+      for k, lev in enumerate(levels):
+          for p, poll in enumerate(pollutants):
+              if np.any(self.cube[:, k, p] != 0):
+                 self.conc_names.append(self._col_name(poll, lev))
+                 if poll not in self.species:
+                    self.species.append(poll)
+      self._concframe = None
+      if self.pdates:
+         self.sdate = self.pdates[0][0]
+         self.edate = self.pdates[-1][1]
+      self.dataflag = bool(self.conc_names)
+      self.thicknesses()
+
+  def _aggregate(self, pdates, cube):
+      """returns a new ModelBin (readwrite='w') with the header of this one and the sampling periods pdates
+         and concentrations cube (time, level, pollutant, nlat, nlon). It can be written with the write method."""
+      model = ModelBin('', cdir='', century=self.century, readwrite='w',
+                       species=self.select_species, levels=self.select_levels)
+      for att in ('nlat', 'nlon', 'dlat', 'dlon', 'llcrnr_lat', 'llcrnr_lon', 'metmodel', 'metdate',
+                  'sourcedate', 'slat', 'slon', 'sht', 'levels', 'pollutants'):
+          setattr(model, att, getattr(self, att))
+      model.pdates = list(pdates)
+      model.cube = cube
+      model._cube_names()
+      return model
+
+  def _period_minutes(self):
+      """returns the first sample start (numpy datetime64) and the start and length of each sampling
+         period in self.pdates in minutes since then (float64 arrays)."""
+      sdates = np.array([pdate[0] for pdate in self.pdates], dtype='M8[m]')
+      edates = np.array([pdate[1] for pdate in self.pdates], dtype='M8[m]')
+      start = (sdates - sdates[0]).astype(np.float64)
+      duration = (edates - sdates).astype(np.float64)
+      return sdates[0], start, duration
+
+  def _cumulative(self, duration):
+      """returns (total, covered). total[t] is the time integral (concentration * hours) of self.cube
+         over the sampling periods before period t (float64, first axis has length time + 1).
+         covered[t] is the number of hours in those sampling periods."""
+      if self.cube is None:
+         self._frame_cube()
+      shape = (-1,) + (1,) * (self.cube.ndim - 1)
+      total = np.zeros((self.cube.shape[0] + 1,) + self.cube.shape[1:], dtype=np.float64)
+      total[1:] = self.cube
+      total[1:] *= duration.reshape(shape) / 60.0
+      np.cumsum(total[1:], axis=0, out=total[1:])
+      covered = np.concatenate(([0], np.cumsum(duration / 60.0)))
+      return total, covered
+
+  def _integral(self, total, covered, start, duration, times):
+      """returns the time integral (concentration * hours) from the first sample start to each of times
+         (minutes since first sample start) and the number of hours of sampling period in that time.
+         Concentrations are constant over a sampling period and are not counted in gaps between periods."""
+      tii = np.searchsorted(start, times, side='right') - 1
+      tcc = np.clip(tii, 0, len(start) - 1)
+      elapsed = np.where(tii >= 0, np.clip(times - start[tcc], 0, duration[tcc]), 0) / 60.0
+      shape = (-1,) + (1,) * (self.cube.ndim - 1)
+      return total[tcc] + self.cube[tcc] * elapsed.reshape(shape), covered[tcc] + elapsed
+
+  def window_mean(self, windows, min_coverage=1.0):
+      """returns a ModelBin with the time averaged concentration for each window (see _aggregate).
+         windows - list of (start, stop) datetime objects. They may have any length and need not line up
+                   with the sampling periods. Sampling periods which are partly in a window are weighted by the
+                   part of the sampling period in the window.
+         min_coverage - windows for which less than this fraction of the time is covered by sampling periods
+                        are left out. The average is over the covered time.
+         All windows are computed at once from the cumulative sum of concentration * period length."""
+      if not self.pdates:
+         print('Warning: no sampling periods to average')
+         return False
+      sdate0, start, duration = self._period_minutes()
+      total, covered = self._cumulative(duration)
+      wstart = (np.array([window[0] for window in windows], dtype='M8[m]') - sdate0).astype(np.float64)
+      wstop = (np.array([window[1] for window in windows], dtype='M8[m]') - sdate0).astype(np.float64)
+      int1, cov1 = self._integral(total, covered, start, duration, wstart)
+      int2, cov2 = self._integral(total, covered, start, duration, wstop)
+      hours = cov2 - cov1
+      valid = (hours > 0) & (hours >= min_coverage * (wstop - wstart) / 60.0 - 1e-6)
+      shape = (-1,) + (1,) * (self.cube.ndim - 1)
+      cube = ((int2[valid] - int1[valid]) / hours[valid].reshape(shape)).astype(np.float32)
+      return self._aggregate([windows[iii] for iii in np.flatnonzero(valid)], cube)
+
+  def rolling_mean(self, hours=8, min_coverage=1.0):
+      """returns a ModelBin with the average over the hours before the end of each sampling period.
+         The sampling period of each average is (end - hours, end). e.g. hours=8 or hours=24 for
+         rolling 8 or 24 hour averages. See window_mean."""
+      windows = [(pdate[1] - datetime.timedelta(hours=hours), pdate[1]) for pdate in self.pdates]
+      return self.window_mean(windows, min_coverage=min_coverage)
+
+  def _days(self, dates):
+      """returns the day (numpy datetime64) of each of dates."""
+      return np.array(dates, dtype='M8[m]').astype('M8[D]')
+
+  def daily_mean(self, min_coverage=1.0):
+      """returns a ModelBin with the average over each day (00 to 24 UTC) from the first sample start to the last
+         sample stop. See window_mean."""
+      if not self.pdates:
+         print('Warning: no sampling periods to average')
+         return False
+      first, last = self._days([self.pdates[0][0], self.pdates[-1][1] - datetime.timedelta(minutes=1)])
+      days = np.arange(first, last + 1).astype('M8[m]').astype(datetime.datetime)
+      windows = [(day, day + datetime.timedelta(days=1)) for day in days]
+      return self.window_mean(windows, min_coverage=min_coverage)
+
+  def daily_max(self):
+      """returns a ModelBin with the maximum concentration in each grid cell over the sampling periods
+         which start on each day. The sampling period of each maximum is the day (00 to 24 UTC).
+         e.g. self.rolling_mean(8).daily_max() for the daily maximum 8 hour average."""
+      if not self.pdates:
+         print('Warning: no sampling periods to find the maximum of')
+         return False
+      if self.cube is None:
+         self._frame_cube()
+      days = self._days([pdate[0] for pdate in self.pdates])
+      first = np.flatnonzero(np.concatenate(([True], days[1:] != days[:-1])))
+      cube = np.maximum.reduceat(self.cube, first, axis=0)
+      days = days[first].astype('M8[m]').astype(datetime.datetime)
+      return self._aggregate([(day, day + datetime.timedelta(days=1)) for day in days], cube)
+
+  def running_total(self):
+      """returns a ModelBin with the time integral (concentration * hours) from the first sample start to the end of
+         each sampling period. The sampling period of each total is (first sample start, end)."""
+      if not self.pdates:
+         print('Warning: no sampling periods to sum')
+         return False
+      sdate0, start, duration = self._period_minutes()
+      total, covered = self._cumulative(duration)
+      pdates = [(self.pdates[0][0], pdate[1]) for pdate in self.pdates]
+      return self._aggregate(pdates, total[1:].astype(np.float32))
+
+  def running_max(self):
+      """returns a ModelBin with the maximum concentration in each grid cell from the first sample start to the end of
+         each sampling period. The sampling period of each maximum is (first sample start, end)."""
+      if not self.pdates:
+         print('Warning: no sampling periods to find the maximum of')
+         return False
+      if self.cube is None:
+         self._frame_cube()
+      pdates = [(self.pdates[0][0], pdate[1]) for pdate in self.pdates]
+      return self._aggregate(pdates, np.maximum.accumulate(self.cube, axis=0))
+
+  def get_area(self):
+      """returns float64 array (nlat, nlon) of the area of each grid cell in square meters.
+         Cells are centered on the latitudes and longitudes from get_latlon."""
+      grid = self._grid()
+      return np.repeat(_cell_area(grid[0], grid[2], grid[4], grid[3])[:, np.newaxis], grid[1], axis=1)
+
+  def coarsen(self, factor):
+      """returns a ModelBin on a coarser grid (see _aggregate).
+         factor - integer or (latitude factor, longitude factor). Each new grid cell is a block of
+                  factor source grid cells. The concentration is the area weighted mean over the block so
+                  mass (concentration * area) is conserved. If nlat or nlon is not a multiple of the factor
+                  the last row or column of blocks extends past the source grid where the concentration is 0.
+         Uses block sums of a reshaped array so there are no loops over grid cells."""
+      if np.isscalar(factor):
+         factor = (factor, factor)
+      flat, flon = int(factor[0]), int(factor[1])
+      nlat, nlon, dlat, dlon, llcrnr_lat, llcrnr_lon = self._grid()
+      if self.cube is None:
+         self._frame_cube()
+      ny = -(-nlat // flat)
+      nx = -(-nlon // flon)
+      area = _cell_area(ny * flat, dlat, llcrnr_lat, dlon)
+      pad = [(0, 0)] * (self.cube.ndim - 2) + [(0, ny * flat - nlat), (0, nx * flon - nlon)]
+      mass = np.pad(self.cube, pad) * area.astype(np.float32)[:, np.newaxis]
+      mass = mass.reshape(self.cube.shape[:-2] + (ny, flat, nx, flon)).sum(axis=(-3, -1))
+      barea = area.reshape(ny, flat).sum(axis=1) * flon
+      barea[barea <= 0] = 1
+      cube = (mass / barea[:, np.newaxis]).astype(np.float32)
+      grid = (ny, nx, dlat * flat, dlon * flon, llcrnr_lat + (flat - 1) * dlat / 2.0, llcrnr_lon + (flon - 1) * dlon / 2.0)
+      return self._regridded(grid, cube)
+
+  def regrid(self, grid):
+      """returns a ModelBin on another grid (see _aggregate).
+         grid - ModelBin or tuple (nlat, nlon, dlat, dlon, llcrnr_lat, llcrnr_lon) describing the new grid
+                (see _grid). The new grid can be finer, coarser or shifted.
+         The concentration in each new grid cell is the mean of the source concentrations weighted by the area
+         of overlap, so mass is conserved where the new grid covers the source grid.
+         The overlap weights are a scipy.sparse matrix (see _regrid_weights) which is cached for each pair of
+         grids. Use coarsen for integer factors."""
+      if isinstance(grid, ModelBin):
+         grid = grid._grid()
+      grid = (int(grid[0]), int(grid[1]), float(grid[2]), float(grid[3]), float(grid[4]), float(grid[5]))
+      if self.cube is None:
+         self._frame_cube()
+      weights = _regrid_weights(self._grid(), grid)
+      src = self.cube.reshape(-1, self.nlat * self.nlon)
+      cube = weights.dot(src.T).T.astype(np.float32)
+      return self._regridded(grid, cube.reshape(self.cube.shape[:-2] + (grid[0], grid[1])))
+
+  def _regridded(self, grid, cube):
+      """returns a ModelBin (see _aggregate) with the concentrations cube on the grid described by
+         grid (nlat, nlon, dlat, dlon, llcrnr_lat, llcrnr_lon)."""
+      model = self._aggregate(self.pdates, cube)
+      model.nlat, model.nlon, model.dlat, model.dlon, model.llcrnr_lat, model.llcrnr_lon = grid
+      model.nlat = np.int32(model.nlat)
+      model.nlon = np.int32(model.nlon)
+      model.dlat = np.float32(model.dlat)
+      model.dlon = np.float32(model.dlon)
+      model.llcrnr_lat = np.float32(model.llcrnr_lat)
+      model.llcrnr_lon = np.float32(model.llcrnr_lon)
+      return model
 
   def _col_name(self, poll, lev):
       """concentration column name for panda dataframe describing pollutant and level"""
@@ -130,7 +540,8 @@ class ModelBin(object):
 
 
          TO DO - implement units which would allow unit transformation and unit meta data to be added.
-         TO DO - implement cthresh which would implement a threshold on the concentration.
+         cthresh - values (mass loading or concentration) which do not exceed cthresh are set to 0.
+                   The ensemble module uses the same test for exceedance probabilities.
          """
 
       self.concframe.fillna(0, inplace=True)
@@ -143,13 +554,13 @@ class ModelBin(object):
          try:
            concframe = self.concframe.xs(pdate).copy()    #takes slice of panda dataframe only for those dates
          except:
-           lat2d, lon2d = self.get_latlon(grid=1)
+           lat2d, lon2d = self._latlon_grid()
            return np.zeros_like(lat2d) + -1               #if dates don't exist return array of zeros.
       #print concframe.info()
       if species is None:
          species = self.species
       if levels is None:
-         levels = self.levels 
+         levels = self._axes()[0]
       lnames =[]
 
       ##Add species loop
@@ -190,66 +601,295 @@ class ModelBin(object):
 
       if grid == 0:
          if mass_loading != 1:
-            return list(concframe['mass_loading'])              #return mass loading list
+            values = concframe['mass_loading'].values              #mass loading list
          else:
-            return list(concframe['mass_loading'] / thickness)  #return concentration list
+            values = concframe['mass_loading'].values / thickness  #concentration list
+         if cthresh > 0:
+            values = np.where(values > cthresh, values, 0)
+         return list(values)
       else:
-         lat2d, lon2d = self.get_latlon(grid=1)
-         conc2d = np.zeros_like(lat2d)
-         indx = list(concframe['indx'])
-         jndx = list(concframe['jndx'])
-         ml = list(concframe['mass_loading'])
-         k = 0
-         for i in indx:
-             j =jndx[k]
-             conc2d[j-1][i-1]  = ml[k]   #need to subtract one because fortran arrays start at index 1 while python arrays start at index 0.
-             k+=1
+         lat2d, lon2d = self._latlon_grid()
+         conc2d = np.zeros(lat2d.shape)
+         #need to subtract one because fortran arrays start at index 1 while python arrays start at index 0.
+         conc2d[concframe['jndx'].values - 1, concframe['indx'].values - 1] = concframe['mass_loading'].values
          if mass_loading != 1:
             conc2d = conc2d / thickness
+         if cthresh > 0:
+            conc2d[conc2d <= cthresh] = 0
          return  conc2d                  #returns 2d array of mass loading or concentration.
 
 
 
-  def xtract_point(self, latpt, lonpt, drange=[]):
-      #TO DO look at latlon grid. Find concentration at only a location
-      # Find i,j, indx corresponding to latlon location
-      ##not functional yet.
-      # Nearest grid or Bilinear interpolater
-      lat, lon = get_latlon(grid=0)
-      lat = np.array(lat)
-      lon = np.array(lon)
-      latdiff = np.abs(lat-latpt)
-      londiff = np.abs(lon-lonpt)
-      iii = np.where(latdiff == np.min(latdiff))
-      jjj = np.where(londiff == np.min(londiff))
-      return -1 
+  def get_concentration_cube(self, pdates=None, species=None, levels=None, mass_loading=1, cthresh=0, multx=1):
+      """returns float32 array (time, nlat, nlon) of mass loading or concentration for a list of sampling periods.
+         Each time is the same as get_concentration(pdate, species, levels, mass_loading, cthresh=cthresh,
+         grid=1, multx=multx) but all the times are computed at once.
+         pdates - list of sample start dates (or (start, stop) tuples as in self.pdates). if None uses self.pdates.
+                  Dates which are not in self.pdates are set to -1 as in get_concentration.
+         species, levels - lists of pollutants and levels to sum. if None uses all of them.
+         The sum over species and the depth weighted sum over levels (self.depth * multx) is one contraction
+         with a (level, pollutant) weight array. From self.cube it is an einsum over the cube. From
+         self.concframe the weighted concentration columns are summed for all rows at once and scattered
+         into the array, so the dataframe is not copied or changed for each date.
+         For a file which was scanned (readwrite='s' or follow) the records are read from the file."""
+      if pdates is None:
+         pdates = self.pdates
+      sdates = [pdate[0] if isinstance(pdate, tuple) else pdate for pdate in pdates]
+      axlevels, axpollutants = self._axes()
+      weights, thickness = self._level_weights(species=species, levels=levels, multx=multx)
+      tindex = dict((pdate[0], t) for t, pdate in enumerate(self.pdates))
+      tpos = np.array([tindex.get(sdate, -1) for sdate in sdates], dtype=int)
+      conc = np.zeros((len(sdates), self.nlat, self.nlon), dtype=np.float32)
+      if self.cube is not None:
+         #the cube is contracted in place. indexing it with tpos would copy every level and pollutant.
+         if np.array_equal(tpos, np.arange(self.cube.shape[0])):
+            np.einsum('kp,tkpyx->tyx', weights, self.cube, out=conc)
+         else:
+            for t in np.flatnonzero(tpos >= 0):
+                np.einsum('kp,kpyx->yx', weights, self.cube[tpos[t]], out=conc[t])
+      elif self.concframe is not None:
+         index = self.concframe.index
+         rowdates = pd.DatetimeIndex(np.asarray(index.levels[0]))
+         #position in sdates of each row. -1 if the row is for a date which was not asked for.
+         rowpos = pd.Index(pd.DatetimeIndex(sdates)).get_indexer(rowdates)[index.codes[0]]
+         rows = rowpos >= 0
+         values = np.zeros(int(np.sum(rows)), dtype=np.float32)
+         for k, lev in enumerate(axlevels):
+             for p, poll in enumerate(axpollutants):
+                 if weights[k, p] != 0:
+                    col = self.concframe[self._col_name(poll, lev)].values[rows]
+                    values += weights[k, p] * np.nan_to_num(col.astype(np.float32))
+         #need to subtract one because fortran arrays start at index 1 while python arrays start at index 0.
+         conc[rowpos[rows], self.concframe['jndx'].values[rows] - 1, self.concframe['indx'].values[rows] - 1] = values
+      elif self.cmap is not None and self.cmap.index is not None:
+         #scanned or followed file (readwrite='s'). Only the records for the dates asked for are read.
+         kindex = dict((lev, k) for k, lev in enumerate(axlevels))
+         pindex = dict((poll, p) for p, poll in enumerate(axpollutants))
+         for t, sdate in enumerate(sdates):
+             if tpos[t] < 0:
+                continue
+             for (poll, lev), (indx, jndx, cvals) in self._records(sdate).items():
+                 if weights[kindex[lev], pindex[poll]] != 0:
+                    conc[t, jndx - 1, indx - 1] += weights[kindex[lev], pindex[poll]] * cvals
+      if mass_loading != 1:
+         conc /= thickness
+      if cthresh > 0:
+         conc[conc <= cthresh] = 0
+      conc[tpos < 0] = -1
+      return conc
+
+  def _level_weights(self, species=None, levels=None, multx=1):
+      """returns (weights, thickness). weights is float32 array (level, pollutant) for the axes returned by _axes.
+         It is self.depth * multx for the levels and pollutants summed by get_concentration_cube and 0 for others.
+         thickness is the sum of self.depth for the levels summed (used to divide by when mass_loading is not 1).
+         species, levels - lists of pollutants and levels to sum. if None uses all of them."""
+      axlevels, axpollutants = self._axes()
+      if species is None:
+         species = self.species
+      if levels is None:
+         levels = axlevels
+      weights = np.zeros((len(axlevels), len(axpollutants)), dtype=np.float32)
+      thickness = 0
+      for k, lev in enumerate(axlevels):
+          #The deposition level has 0 depth so it will not contribute to the column mass loading.
+          if lev == 0 or lev not in levels:
+             continue
+          thickness += self.depth[str(lev)]
+          for p, poll in enumerate(axpollutants):
+              if poll in species and self._col_name(poll, lev) in self.conc_names:
+                 weights[k, p] = self.depth[str(lev)] * multx
+      return weights, thickness
+
+  def _records(self, pdate=None):
+      """returns dictionary for the sampling period which starts at pdate (default is first sampling period).
+         key is (poll, lev). value is (indx, jndx, conc) arrays of the nonzero concentrations.
+         Taken from self.cube if it is not None otherwise straight from the file (see read_period)."""
+      if pdate is None:
+         pdate = self.pdates[0][0]
+      records = {}
+      if self.cube is not None:
+         levels, pollutants = self._axes()
+         sdates = [pdates[0] for pdates in self.pdates]
+         if pdate not in sdates:
+            return records
+         t = sdates.index(pdate)
+         for k, lev in enumerate(levels):
+             for p, poll in enumerate(pollutants):
+                 jjj, iii = np.nonzero(self.cube[t, k, p])
+                 if jjj.shape[0] > 0:
+                    records[(poll, lev)] = (iii + 1, jjj + 1, self.cube[t, k, p, jjj, iii])
+      else:
+         for poll, lev, cview in self.read_period(pdate, species=self.select_species, levels=self.select_levels):
+             if cview.shape[0] > 0:
+                records[(poll, lev)] = (cview['indx'], cview['jndx'], cview['conc'])
+      return records
+
+  def get_sparse(self, pdate=None, fmt='csr'):
+      """returns dictionary of scipy.sparse matrices (nlat, nlon) of concentration for the sampling period
+         which starts at pdate (default is first sampling period). key is (poll, lev).
+         The matrices are built straight from the (indx, jndx, conc) records without creating dense arrays.
+         fmt - 'csr' or 'coo'."""
+      from scipy import sparse   #scipy is only needed for the sparse methods.
+      smatrices = {}
+      for key, (indx, jndx, conc) in self._records(pdate).items():
+          smatrix = sparse.coo_matrix((np.asarray(conc, dtype=np.float32), (np.asarray(jndx, dtype=np.int32) - 1,
+                                      np.asarray(indx, dtype=np.int32) - 1)), shape=(self.nlat, self.nlon))
+          smatrices[key] = smatrix.asformat(fmt)
+      return smatrices
+
+  def get_sparse_concentration(self, pdate=None, species=None, levels=None, mass_loading=1, multx=1, fmt='csr'):
+      """returns scipy.sparse matrix (nlat, nlon) of mass loading or concentration for the sampling period
+         which starts at pdate. Same as get_concentration with grid=1 but the result is sparse.
+         species - list of pollutant identifiers to add together. if None then all species.
+         levels - list of levels. if None then all levels. The deposition level (0) has 0 depth.
+         if mass_loading = 1 returns column mass loading (sum of concentration * self.depth * multx)
+         else returns concentration (mass loading divided by total depth of the levels).
+         fmt - 'csr' or 'coo'."""
+      from scipy import sparse   #scipy is only needed for the sparse methods.
+      if levels is None:
+         levels = self._axes()[0]
+      thickness = 0
+      for lev in levels:
+          if lev != 0:
+             thickness += self.depth[str(lev)]
+      rows = []
+      cols = []
+      values = []
+      for (poll, lev), (indx, jndx, conc) in self._records(pdate).items():
+          if species is not None and poll not in species:
+             continue
+          if lev not in levels or lev == 0:
+             continue
+          rows.append(np.asarray(jndx, dtype=np.int32) - 1)
+          cols.append(np.asarray(indx, dtype=np.int32) - 1)
+          values.append(np.asarray(conc, dtype=np.float32) * np.float32(self.depth[str(lev)] * multx))
+      if rows:
+         smatrix = sparse.coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                     shape=(self.nlat, self.nlon))
+      else:
+         smatrix = sparse.coo_matrix((self.nlat, self.nlon), dtype=np.float32)
+      smatrix = smatrix.tocsr()    #adds together duplicate entries (same grid point in different levels / species)
+      if mass_loading != 1:
+         smatrix = smatrix / thickness
+      return smatrix.asformat(fmt)
+
+  def xtract_point(self, latpt, lonpt, drange=[], method='nearest'):
+      """returns concentrations at a list of lat-lon points (receptors).
+         latpt, lonpt - latitude and longitude of the receptors. Can be numbers or lists / arrays.
+         drange - [date1, date2]. if not [] then only sampling periods within drange are returned.
+         method - 'nearest' returns the concentration of the nearest grid point.
+                  'bilinear' interpolates between the four surrounding grid points.
+         returns float32 array (receptor, period, species, level).
+         The period axis corresponds to self.pdates (within drange). The species and level axes
+         correspond to the pollutants and levels returned by _axes.
+         Receptors outside the concentration grid are NaN.
+         The grid indices and weights are computed once (see _point_index) and used for all periods."""
+      jjj, iii, weights, inside = self._point_index(latpt, lonpt, method=method)
+      levels, pollutants = self._axes()
+      tsel = [t for t, pdate in enumerate(self.pdates) if self._test_dates(pdate[0], pdate[1], drange)[0]]
+      if self.cube is not None:
+         #cube[t, k, p, jjj, iii] has shape (period, level, pollutant, receptor, corner)
+         #the receptor cells are gathered first so the whole cube is not copied.
+         values = np.take(self.cube[:, :, :, jjj, iii], tsel, axis=0)
+         xtract = np.einsum('tkprc,rc->rtpk', values, weights).astype(np.float32)
+      else:
+         kindex = dict((lev, k) for k, lev in enumerate(levels))
+         pindex = dict((poll, p) for p, poll in enumerate(pollutants))
+         xtract = np.zeros((len(iii), len(tsel), len(pollutants), len(levels)), dtype=np.float32)
+         #cell number of the grid points used for each receptor. found in the sorted cell numbers of each record.
+         rcells = jjj * self.nlon + iii
+         for nnn, (pdate1, pdate2, records) in enumerate(self._period_records([self.pdates[t] for t in tsel])):
+             for (poll, lev), (indx, jndx, conc) in records.items():
+                 cells = (np.asarray(jndx, dtype=np.int64) - 1) * self.nlon + np.asarray(indx, dtype=np.int64) - 1
+                 conc = np.asarray(conc)
+                 if np.any(cells[1:] < cells[:-1]):
+                    order = np.argsort(cells, kind='stable')
+                    cells = cells[order]
+                    conc = conc[order]
+                 pos = np.minimum(np.searchsorted(cells, rcells), max(cells.size - 1, 0))
+                 values = np.where(cells[pos] == rcells, conc[pos], 0) if cells.size else np.zeros(rcells.shape)
+                 xtract[:, nnn, pindex[poll], kindex[lev]] = (values * weights).sum(axis=1)
+      xtract[~inside] = np.nan
+      return xtract
+
+  def _point_index(self, latpt, lonpt, method='nearest'):
+      """returns (jjj, iii, weights, inside) for a list of lat-lon points.
+         jjj, iii - (python) grid indices of the grid points used for each point. shape (npoints, ncorner)
+                    where ncorner is 1 for method='nearest' and 4 for method='bilinear'.
+         weights - weight of each grid point. shape (npoints, ncorner).
+         inside - boolean array which is False for points outside the grid."""
+      latpt = np.atleast_1d(np.asarray(latpt, dtype=float))
+      lonpt = np.atleast_1d(np.asarray(lonpt, dtype=float))
+      fjj = (latpt - self.llcrnr_lat) / self.dlat
+      fii = _lon_index(lonpt, self.llcrnr_lon, self.dlon)
+      wrap = _global_lon(self.nlon, self.dlon)
+      if method == 'nearest':
+         jjj = np.round(fjj).astype(int)
+         iii = np.round(fii).astype(int)
+         if wrap:
+            iii = iii % self.nlon
+         inside = (jjj >= 0) & (jjj < self.nlat) & (iii >= 0) & (iii < self.nlon)
+         jjj = np.clip(jjj, 0, self.nlat - 1)[:, np.newaxis]
+         iii = np.clip(iii, 0, self.nlon - 1)[:, np.newaxis]
+         weights = np.ones(jjj.shape)
+      elif method == 'bilinear':
+         jj0 = np.clip(np.floor(fjj).astype(int), 0, max(self.nlat - 2, 0))
+         if wrap:
+            #global grid. the last column is next to the first one.
+            ii0 = np.floor(fii).astype(int)
+            wii = fii - ii0
+            ii0 = ii0 % self.nlon
+            ii1 = (ii0 + 1) % self.nlon
+         else:
+            ii0 = np.clip(np.floor(fii).astype(int), 0, max(self.nlon - 2, 0))
+            wii = fii - ii0
+            ii1 = ii0 + 1
+         wjj = fjj - jj0
+         inside = (wjj >= 0) & (wjj <= 1) & (wii >= 0) & (wii <= 1)
+         jjj = np.stack([jj0, jj0, jj0 + 1, jj0 + 1], axis=1)
+         iii = np.stack([ii0, ii1, ii0, ii1], axis=1)
+         weights = np.stack([(1 - wjj) * (1 - wii), (1 - wjj) * wii, wjj * (1 - wii), wjj * wii], axis=1)
+         jjj = np.clip(jjj, 0, self.nlat - 1)
+         iii = np.clip(iii, 0, self.nlon - 1)
+      else:
+         raise ValueError('ModelBin xtract_point: method must be nearest or bilinear not ' + str(method))
+      weights[~inside] = 0
+      return jjj, iii, weights, inside
 
 
       
   def get_latlon(self, grid=0):
-      """ returns latitude and longitude. if grid=1 then returns 2d arrays of latittude and longitude. Otherwise returns a list.""" 
-      lat = np.arange(self.llcrnr_lat, self.llcrnr_lat+ self.nlat.astype(self.dlat.dtype) * self.dlat, self.dlat)
-      lon = np.arange(self.llcrnr_lon, self.llcrnr_lon+ self.nlon.astype(self.dlon.dtype) * self.dlon, self.dlon)
-      #if 'lat' not in self.concframe.columns:
-      #    flat = lambda x : lat[x-1]
-      #    flon = lambda x : lon[x-1]
-      #    self.concframe['lat'] = self.concframe['jndx'].apply(flat)
-      #    self.concframe['lon'] = self.concframe['indx'].apply(flon)
+      """ returns latitude and longitude. if grid=1 then returns 2d arrays of latittude and longitude. Otherwise returns a list.
+          The 2d arrays are copies of the cached arrays (see _latlon_grid) so they can be changed.""" 
       if grid ==0:
            return list(self.concframe['lat']) , list(self.concframe['lon'])
       else:
-           # should be equal to lon2d, lat2d = np.meshgrid(lon, lat)
-           lon2d, lat2d = np.meshgrid(lon, lat)
-           temp1 = np.zeros((lat.shape[0], lon.shape[0]))
-           temp2 = np.zeros((lat.shape[0], lon.shape[0]))
-           
-           temp1[:,] = lon
-           lon2d = temp1
-
-           latm = matrix(lat)
-           temp2[:,] = latm.T
-           lat2d = temp2
-           return lat2d, lon2d
+           lat2d, lon2d = self._latlon_grid()
+           return lat2d.copy(), lon2d.copy()
+
+  def _latlon_grid(self):
+      """returns 2d arrays (nlat, nlon) of latitude and longitude. The arrays are computed once and cached.
+         They are read only. Used inside the class where the arrays are not changed."""
+      if self._latlon2d is None:
+         lat, lon = self._latlon_axes()
+         lon2d, lat2d = np.meshgrid(lon, lat)
+         lat2d.flags.writeable = False
+         lon2d.flags.writeable = False
+         self._latlon2d = (lat2d, lon2d)
+      return self._latlon2d
+
+  def _latlon_axes(self):
+      """returns 1d arrays of the latitudes (nlat) and longitudes (nlon) of the grid.
+         The arrays are computed once and cached. They are read only."""
+      if self._latlon is None:
+         lat = np.arange(self.llcrnr_lat, self.llcrnr_lat+ self.nlat.astype(self.dlat.dtype) * self.dlat, self.dlat)
+         lon = np.arange(self.llcrnr_lon, self.llcrnr_lon+ self.nlon.astype(self.dlon.dtype) * self.dlon, self.dlon)
+         lat = lat[:self.nlat].astype(float)
+         lon = lon[:self.nlon].astype(float)
+         lat.flags.writeable = False
+         lon.flags.writeable = False
+         self._latlon = (lat, lon)
+      return self._latlon
 
 
   @staticmethod
@@ -346,6 +986,445 @@ class ModelBin(object):
  
      return rec1, rec2, rec3, rec4a , rec4b, rec5a, rec5b, rec5c, rec6, rec8a, rec8b, rec8c
 
+  def _test_dates(self, pdate1, pdate2, drange):
+      """returns (savedata, testf).
+         savedata is True if the sampling period pdate1 to pdate2 is within drange or drange is [].
+         testf is False if the sampling period is past drange and no more periods need to be looked at."""
+      if drange ==[]:
+         return True, True
+      elif pdate1 >= drange[0] and pdate1 <= drange[1] and pdate2 <= drange[1]:
+         return True, True
+      elif pdate1 > drange[1] or pdate2 > drange[1]:
+         return False, False
+      else:
+         return False, True
+
+  def scan(self, sidecar=False):
+      """reads only the header (records 1-5) and the headers of the concentration records
+         (records 6, 7 and 8a) and builds an index of the byte offsets of the concentration records
+         (stored in self.cmap.index, see CdumpMap.scan). The concentrations are not read.
+         Sets self.pdates, self.species and self.conc_names for sampling periods within self.drange.
+         if sidecar is True then the index is loaded from a sidecar file next to the cdump file if it is
+         up to date. Otherwise the index is built and saved to the sidecar file.
+         Use read_period to get the concentrations for one sampling period.
+         returns False if all concentrations are zero else returns True."""
+      self.cmap = None
+      self._open()
+      if not (sidecar and self.cmap.load_index()):
+         self.cmap.scan()
+         if sidecar:
+            self.cmap.save_index()
+      index = self.cmap.index
+      nrec = len(self.levels) * len(self.cmap.pollutants)
+      self.pdates = []
+      tempzeroconcdates = []
+      if nrec > 0:
+         for prow in index[::nrec]:
+             pdate1 = prow['sdate'].astype(datetime.datetime)
+             pdate2 = prow['edate'].astype(datetime.datetime)
+             savedata, testf = self._test_dates(pdate1, pdate2, self.drange)
+             if not testf:
+                break
+             if savedata:
+                self.pdates.append((pdate1, pdate2))
+      index = index[self._select(index)]
+      for row in index:
+          pdate1 = row['sdate'].astype(datetime.datetime)
+          if row['ne'] >= 1:
+             self.nonzeroconcdates.append(pdate1)
+          else:
+             tempzeroconcdates.append(pdate1)
+      sdates = [np.datetime64(pdate[0], 'm') for pdate in self.pdates]
+      for row in index[np.isin(index['sdate'], sdates) & (index['ne'] >= 1)]:
+          col_name = self._col_name(row['poll'], row['lev'])
+          if col_name not in self.conc_names:
+             self.conc_names.append(col_name)
+          if row['poll'] not in self.species:
+             self.species.append(str(row['poll']))
+      for dt in tempzeroconcdates:
+          if dt not in self.nonzeroconcdates:
+             self.zeroconcdates.append(dt)
+      if self.conc_names == []:
+         print('Warning: ModelBin class scan method: no data in the date range found')
+         return False
+      self.sdate = self.pdates[0][0]
+      self.edate = self.pdates[-1][1]
+      return True
+
+  def read_period(self, pdate, species=None, levels=None):
+      """returns list of (poll, lev, view) for the sampling period which starts at pdate.
+         view is a zero-copy numpy view (indx, jndx, conc) of the concentration record in the file.
+         species - list of pollutant identifiers. if None then all pollutants are returned.
+         levels - list of levels. if None then all levels are returned.
+         Only the records asked for are looked at. Can be used after scan or _readfile."""
+      return self._open().records(pdate, species=species, levels=levels)
+
+  def _axes(self):
+      """returns (levels, pollutants), lists of the levels and pollutants which are read from the file.
+         These are all the levels and pollutants in the file unless species or levels were given to __init__."""
+      levels = [lev for lev in self.levels if self.select_levels is None or lev in self.select_levels]
+      pollutants = [poll for poll in self.pollutants if self.select_species is None or poll in self.select_species]
+      return levels, pollutants
+
+  def _select(self, index):
+      """returns boolean array which is True for the rows of index (see CdumpMap.scan) for the
+         pollutants and levels which are read from the file."""
+      levels, pollutants = self._axes()
+      return np.isin(index['lev'], levels) & np.isin(index['poll'], pollutants)
+
+  def _open(self):
+      """memory maps the file (self.cmap) and reads the header if that has not been done yet."""
+      if self.cmap is None:
+         if self._cachemap is not None:
+            self.cmap = self._cachemap
+         else:
+            self.cmap = CdumpMap(self.filename, century=self.century)
+         self._header(self.cmap)
+      return self.cmap
+
+  def iter_periods(self):
+      """generator which yields a CdumpPeriod object for each sampling period within self.drange, one at a time.
+         The concentrations of earlier periods are not kept, so memory use does not grow with the
+         number of periods and there is no limit on the number of periods.
+         Can be used with readwrite='s' or with any other readwrite value for which the file has not been read."""
+      cmap = self._open()
+      for pdate1, pdate2, records in cmap.iter_periods(species=self.select_species, levels=self.select_levels):
+          savedata, testf = self._test_dates(pdate1, pdate2, self.drange)
+          if not testf:
+             break
+          if savedata:
+             yield CdumpPeriod(self, pdate1, pdate2, records)
+
+  def poll(self):
+      """reads the sampling periods which have been added to the file since the last call (follow mode).
+         Only the records after the last complete sampling period (self.cmap.last_offset) are looked at.
+         A sampling period which is only partly written is left for a later call.
+         The file may be empty or have only part of the header when poll is first called.
+         The new periods are added to the record index (self.cmap.index) and to self.pdates, self.species
+         and self.conc_names so read_period and get_concentration_cube can be used for them.
+         returns list of CdumpPeriod objects for the new sampling periods within self.drange."""
+      if self.cmap is None:
+         try:
+            self._open()
+         except (IOError, ValueError):     #file is empty or header is not complete yet.
+            self.cmap = None
+            return []
+         self.cmap.index = np.zeros(0, dtype=CdumpMap.index_dtype)
+         self.pdates = []
+         self._pastdrange = False
+      elif os.path.getsize(self.filename) < self.cmap.last_offset:
+         print('Warning: ModelBin poll - ' + self.filename + ' is shorter than before. Reading it again.')
+         self.cmap = None
+         return self.poll()
+      else:
+         self.cmap.remap()
+      nold = len(self.cmap.index)
+      index = self.cmap.scan(offset=self.cmap.last_offset)[nold:]
+      periods = []
+      for sdate in index['sdate'][::max(len(self.levels) * len(self.pollutants), 1)]:
+          rows = index[index['sdate'] == sdate]
+          pdate1 = sdate.astype(datetime.datetime)
+          pdate2 = rows['edate'][0].astype(datetime.datetime)
+          savedata, testf = self._test_dates(pdate1, pdate2, self.drange)
+          if not testf:
+             self._pastdrange = True
+             break
+          if not savedata:
+             continue
+          rows = rows[self._select(rows)]
+          period = CdumpPeriod(self, pdate1, pdate2, [self.cmap.conc_view(offset) for offset in rows['offset']])
+          self.pdates.append((pdate1, pdate2))
+          for poll, lev in period.records:
+              col_name = self._col_name(poll, lev)
+              if col_name not in self.conc_names:
+                 self.conc_names.append(col_name)
+              if poll not in self.species:
+                 self.species.append(poll)
+          if period.records:
+             self.nonzeroconcdates.append(pdate1)
+          periods.append(period)
+      if self.pdates:
+         self.sdate = self.pdates[0][0]
+         self.edate = self.pdates[-1][1]
+         self.dataflag = bool(self.conc_names)
+         self.thicknesses()
+      return periods
+
+  def follow(self, interval=10, timeout=None, callbacks=()):
+      """generator which yields a CdumpPeriod for each sampling period as it is written to the file
+         by a HYSPLIT run which is still going (like tail -f). Use with readwrite='' or 's'.
+         The file stays memory mapped and each poll (see poll) reads only the periods added since the last one.
+         interval - seconds to wait between polls when there are no new sampling periods.
+         timeout - stop when no new data has been written for this many seconds. if None keeps waiting
+                   until a sampling period after drange[1] is found.
+         callbacks - list of functions which are called with each new CdumpPeriod before it is yielded."""
+      idle = 0
+      while True:
+          offset = self.cmap.last_offset if self.cmap is not None else None
+          periods = self.poll()
+          for period in periods:
+              for callback in callbacks:
+                  callback(period)
+              yield period
+          if self.cmap is not None and self._pastdrange:
+             return
+          if self.cmap is not None and self.cmap.last_offset != offset:
+             idle = 0
+             continue
+          if timeout is not None and idle >= timeout:
+             return
+          time.sleep(interval)
+          idle += interval
+
+  def _readcube(self):
+      """Data from the file is stored in self.cube, a float32 numpy array with shape
+         (time, level, pollutant, nlat, nlon).
+         The time axis corresponds to self.pdates, the level and pollutant axes to the levels and
+         pollutants returned by _axes. Cells with no concentration are 0.
+         The file is scanned first (see scan) so the array can be allocated once and each
+         concentration record is put straight into it.
+         returns False if all concentrations are zero else returns True."""
+      if not self.scan():
+         return False
+      tindex = {}
+      for t, pdate in enumerate(self.pdates):
+          tindex[np.datetime64(pdate[0], 'm')] = t
+      levels, pollutants = self._axes()
+      kindex = dict((lev, k) for k, lev in enumerate(levels))
+      pindex = dict((poll, p) for p, poll in enumerate(pollutants))
+      self.cube = np.zeros((len(self.pdates), len(levels), len(pollutants), self.nlat, self.nlon),
+                           dtype=np.float32)
+      index = self.cmap.index
+      for row in index[(index['ne'] >= 1) & self._select(index)]:
+          t = tindex.get(row['sdate'])
+          if t is None:
+             continue
+          poll, lev, cview = self.cmap.conc_view(row['offset'])
+          #need to subtract one because fortran arrays start at index 1 while python arrays start at index 0.
+          self.cube[t, kindex[lev], pindex[poll], cview['jndx'] - 1, cview['indx'] - 1] = cview['conc']
+      return True
+
+  def _cube_frame(self):
+      """returns pandas dataframe in the same form as created by _readfile from self.cube.
+         Each row is a grid cell with a nonzero concentration for at least one level and pollutant."""
+      lat, lon = self._latlon_axes()
+      levels, pollutants = self._axes()
+      kindex = dict((str(lev), k) for k, lev in enumerate(levels))
+      pindex = dict((poll, p) for p, poll in enumerate(pollutants))
+      frames = []
+      for t, pdate in enumerate(self.pdates):
+          jjj, iii = np.nonzero(np.any(self.cube[t] != 0, axis=(0, 1)))
+          frame = pd.DataFrame({'indx': (iii + 1).astype(np.int16), 'jndx': (jjj + 1).astype(np.int16)})
+          for lev in levels:
+              for poll in self.species:
+                  col_name = self._col_name(poll, lev)
+                  if col_name in self.conc_names:
+                     frame[col_name] = self.cube[t, kindex[str(lev)], pindex[poll], jjj, iii]
+          frame['sdate'] = pd.Timestamp(pdate[0])
+          frame['edate'] = pd.Timestamp(pdate[1])
+          frames.append(frame)
+      concframe = pd.concat(frames)
+      concframe['idx'] = list(range(0,concframe.shape[0]))
+      concframe.set_index(['sdate', 'idx'],inplace=True)
+      concframe['lat'] = lat[concframe['jndx'].values - 1]
+      concframe['lon'] = lon[concframe['indx'].values - 1]
+      return concframe
+
+  def _new(self):
+      """sets the header attributes to empty values. Used when readwrite='w'.
+         Before calling write set
+         nlat, nlon, dlat, dlon, llcrnr_lat, llcrnr_lon - describe the concentration grid.
+         levels - list of level heights.
+         pollutants - list of pollutant identifiers (4 characters).
+         sourcedate, slat, slon, sht - lists of release times and locations.
+         pdates - list of (sample start, sample stop) for each sampling period.
+         cube - numpy array (time, level, pollutant, nlat, nlon) or concframe.
+         metmodel - meteorological model identifier. metdate - meteorological model starting time."""
+      self.nlat = 0
+      self.nlon = 0
+      self.dlat = 0
+      self.dlon = 0
+      self.llcrnr_lat = 0
+      self.llcrnr_lon = 0
+      self.metmodel = ''
+      self.metdate = None
+      self.sourcedate = []
+      self.slat = []
+      self.slon = []
+      self.sht = []
+      self.levels = []
+      self.pollutants = []
+      self.pdates = []
+
+  def _period_records(self, pdates=None):
+      """generator which yields (sample start, sample stop, records) for each sampling period in pdates
+         (default self.pdates).
+         records is a dictionary. key is (poll, lev). value is (indx, jndx, conc) arrays of the nonzero concentrations
+         ordered by jndx then indx.
+         Created from self.cube if it is not None otherwise from self.concframe."""
+      levels, pollutants = self._axes()
+      if pdates is None:
+         pdates = self.pdates
+      tindex = dict((pdate, t) for t, pdate in enumerate(self.pdates))
+      for pdate in pdates:
+          t = tindex[pdate]
+          records = {}
+          if self.cube is not None:
+             for k, lev in enumerate(levels):
+                 for p, poll in enumerate(pollutants):
+                     jjj, iii = np.nonzero(self.cube[t, k, p])
+                     records[(poll, lev)] = (iii + 1, jjj + 1, self.cube[t, k, p, jjj, iii])
+          else:
+             try:
+                concframe = self.concframe.xs(pd.Timestamp(pdate[0]))
+             except KeyError:
+                concframe = None
+             for lev in levels:
+                 for poll in pollutants:
+                     col_name = self._col_name(poll, lev)
+                     if concframe is None or col_name not in concframe.columns:
+                        continue
+                     conc = concframe[col_name].values
+                     vpi = np.where(np.nan_to_num(conc) != 0)[0]
+                     order = np.lexsort((concframe['indx'].values[vpi], concframe['jndx'].values[vpi]))
+                     vpi = vpi[order]
+                     records[(poll, lev)] = (concframe['indx'].values[vpi], concframe['jndx'].values[vpi], conc[vpi])
+          yield pdate[0], pdate[1], records
+
+  def _header_bytes(self, levels, pollutants):
+      """returns records 1-5 of a cdump file as bytes.
+         If the file was read (self.cmap) records 1-3 are copied from it so that they are written unchanged."""
+      rec1 , rec2, rec3, rec4a, rec4b, rec5a, rec5b, rec5c, rec6, rec8a, rec8b, rec8c = self.define_struct()
+      nstartloc = len(self.slat)
+      if self.cmap is not None and self.cmap.hdata2.shape[0] == nstartloc:
+         hdata1 = self.cmap.hdata1.copy()
+         hdata2 = self.cmap.hdata2.copy()
+         hdata3 = self.cmap.hdata3.copy()
+      else:
+         hdata1 = np.zeros(1, dtype=rec1)
+         hdata1['pad1'] = rec1.itemsize - 8
+         hdata1['pad2'] = rec1.itemsize - 8
+         hdata1['model_id'] = self.metmodel.encode('UTF-8').ljust(4)
+         metdate = self.metdate
+         if metdate is None and self.sourcedate:
+            metdate = self.sourcedate[0]
+         if metdate is not None:
+            hdata1['met_year'] = metdate.year % 100
+            hdata1['met_month'] = metdate.month
+            hdata1['met_day'] = metdate.day
+            hdata1['met_hr'] = metdate.hour
+         hdata1['start_loc'] = nstartloc
+         hdata1['conc_pack'] = 1
+         hdata2 = np.zeros(nstartloc, dtype=rec2)
+         hdata2['pad1'] = rec2.itemsize - 8
+         hdata2['pad2'] = rec2.itemsize - 8
+         hdata2['r_year'] = [sdate.year % 100 for sdate in self.sourcedate]
+         hdata2['r_month'] = [sdate.month for sdate in self.sourcedate]
+         hdata2['r_day'] = [sdate.day for sdate in self.sourcedate]
+         hdata2['r_hr'] = [sdate.hour for sdate in self.sourcedate]
+         hdata2['r_min'] = [sdate.minute for sdate in self.sourcedate]
+         hdata2['s_lat'] = self.slat
+         hdata2['s_lon'] = self.slon
+         hdata2['s_ht'] = self.sht
+         hdata3 = np.zeros(1, dtype=rec3)
+         hdata3['pad1'] = rec3.itemsize - 8
+         hdata3['pad2'] = rec3.itemsize - 8
+         hdata3['nlat'] = self.nlat
+         hdata3['nlon'] = self.nlon
+         hdata3['dlat'] = self.dlat
+         hdata3['dlon'] = self.dlon
+         hdata3['llcrnr_lat'] = self.llcrnr_lat
+         hdata3['llcrnr_lon'] = self.llcrnr_lon
+      nlev = len(levels)
+      hdata4 = np.array([4 + 4 * nlev, nlev] + list(levels) + [4 + 4 * nlev], dtype='>i4')
+      npoll = len(pollutants)
+      hdata5b = np.array([poll.encode('UTF-8').ljust(4) for poll in pollutants], dtype=rec5b)
+      return (hdata1.tobytes() + hdata2.tobytes() + hdata3.tobytes() + hdata4.tobytes() +
+              np.array([4 + 4 * npoll, npoll], dtype='>i4').tobytes() + hdata5b.tobytes() +
+              np.array([4 + 4 * npoll], dtype='>i4').tobytes())
+
+  def write(self, filename=None, verbose=False):
+      """writes a binary cdump file (packed, conc_pack=1) from self.cube if it is not None otherwise from self.concframe.
+         filename - name of file to write. Default is self.filename.
+         Levels and pollutants written are those returned by _axes.
+         Each sampling period (records 6, 7 and 8 for each level and pollutant) is packed into one
+         numpy buffer which is written at once.
+         The forecast hour in records 6 and 7 is taken from the file which was read (self.cmap)
+         otherwise it is 0.
+         A file read with storage='cube' and written again is unchanged."""
+      if filename is None:
+         filename = self.filename
+      rec1 , rec2, rec3, rec4a, rec4b, rec5a, rec5b, rec5c, rec6, rec8a, rec8b, rec8c = self.define_struct()
+      levels, pollutants = self._axes()
+      forecast = {}
+      if self.cmap is not None:
+         forecast = self.cmap.forecast
+      with open(filename, 'wb') as fp:
+          fp.write(self._header_bytes(levels, pollutants))
+          for pdate1, pdate2, records in self._period_records():
+              nelem = {}
+              for lev in levels:
+                  for poll in pollutants:
+                      if (poll, lev) in records:
+                         nelem[(poll, lev)] = len(records[(poll, lev)][2])
+                      else:
+                         nelem[(poll, lev)] = 0
+              nbytes = 2 * rec6.itemsize + sum(rec8a.itemsize + rec8c.itemsize + rec8b.itemsize * ne
+                                               for ne in nelem.values())
+              buf = np.zeros(nbytes, dtype=np.uint8)
+              fhrs = forecast.get(pdate1, (0, 0))
+              hdata6 = buf[0:2 * rec6.itemsize].view(rec6)
+              hdata6['pad1'] = rec6.itemsize - 8
+              hdata6['pad3'] = rec6.itemsize - 8
+              hdata6['oyear'] = [pdate1.year % 100, pdate2.year % 100]
+              hdata6['omonth'] = [pdate1.month, pdate2.month]
+              hdata6['oday'] = [pdate1.day, pdate2.day]
+              hdata6['ohr'] = [pdate1.hour, pdate2.hour]
+              hdata6['omin'] = [pdate1.minute, pdate2.minute]
+              hdata6['oforecast'] = fhrs
+              offset = 2 * rec6.itemsize
+              for lev in levels:
+                  for poll in pollutants:
+                      ne = nelem[(poll, lev)]
+                      reclen = rec8a.itemsize - 4 + rec8b.itemsize * ne
+                      hdata8a = buf[offset:offset + rec8a.itemsize].view(rec8a)
+                      hdata8a['pad1'] = reclen
+                      hdata8a['poll'] = poll.encode('UTF-8').ljust(4)
+                      hdata8a['lev'] = lev
+                      hdata8a['ne'] = ne
+                      offset += rec8a.itemsize
+                      if ne > 0:
+                         indx, jndx, conc = records[(poll, lev)]
+                         hdata8b = buf[offset:offset + rec8b.itemsize * ne].view(rec8b)
+                         hdata8b['indx'] = indx
+                         hdata8b['jndx'] = jndx
+                         hdata8b['conc'] = conc
+                         offset += rec8b.itemsize * ne
+                      buf[offset:offset + rec8c.itemsize].view(rec8c)['pad2'] = reclen
+                      offset += rec8c.itemsize
+              fp.write(buf)
+              if verbose:
+                 print('wrote sampling period', pdate1, pdate2)
+      return filename
+
+  def _header(self, cmap):
+      """copies the header information (records 1-5) from a CdumpMap object into the class attributes."""
+      self.nlat = cmap.nlat
+      self.nlon = cmap.nlon
+      self.dlat = cmap.dlat
+      self.dlon = cmap.dlon
+      self.llcrnr_lon = cmap.llcrnr_lon
+      self.llcrnr_lat = cmap.llcrnr_lat
+      self.metmodel = cmap.metmodel
+      self.metdate = cmap.metdate
+      self.sourcedate = cmap.sourcedate
+      self.slat = cmap.slat
+      self.slon = cmap.slon
+      self.sht = cmap.sht
+      self.levels = cmap.levels
+      self.pollutants = cmap.pollutants
+      self.century = cmap.century
+
   def _readfile(self, filename, drange, verbose, century): 
      """Data from the file is stored in a pandas dataframe.
         returns False if all concentrations are zero else returns True.
@@ -358,198 +1437,103 @@ class ModelBin(object):
         For python 3 the numpy char4 are read in as a numpy.bytes_ class and need to be converted to a python
         string by using decode('UTF-8').
 
+        The file is memory mapped once by a CdumpMap object (stored in self.cmap) and
+        the concentration records are numpy views into the map rather than separate reads.
      """
         ##8/16/2016 moved species=[]  to before while loop. Added print statements when verbose.
 
      self.pdates=[]  #list of tuples giving the (sample start date, sample end date)
-     fp = open(filename, 'rb') 
-
-     ##each record in the fortran binary begins and ends with 4 bytes which specify the length of the record.
-     ##These bytes are called pad1 and pad2 below. They are not used here, but are thrown out. 
-     ##The following block defines a numpy dtype object for each record in the binary file.
-     rec1 , rec2, rec3, rec4a, rec4b, rec5a, rec5b, rec5c, rec6, rec8a, rec8b, rec8c = self.define_struct()
-     rec7 = rec6
+     self.cmap = None
+     self._open()
+     century = self.cmap.century
 
-     #start_loc in rec1 tell how many rec there are.
      tempzeroconcdates =[]   
-     #Reads header data. This consists of records 1-5.
-     hdata1=np.fromfile(fp,dtype=rec1, count=1)
-     nstartloc = hdata1['start_loc'][0]
-     ##in python 3 np.fromfile reads the record into a list even if it is just one number.
-     ##so if the length this record is greater than one something is wrong.
-     if len(hdata1['start_loc']) != 1:
-        print('WARNING in ModelBin _readfile - number of starting locations incorrect')
-        print(hdata1['start_loc'])
-     hdata2=np.fromfile(fp,dtype=rec2, count=nstartloc)
-     hdata3=np.fromfile(fp,dtype=rec3, count=1)
-     self.nlat = hdata3['nlat'][0]
-     self.nlon = hdata3['nlon'][0]
-     self.dlat = hdata3['dlat'][0]
-     self.dlon = hdata3['dlon'][0]
-     self.llcrnr_lon = hdata3['llcrnr_lon'][0]
-     self.llcrnr_lat = hdata3['llcrnr_lat'][0]
-     self.metmodel = hdata1['model_id'][0].decode('UTF-8')
-     self.sourcedate=[]
-     self.slat=[]
-     self.slon=[]
-     self.sht=[]
-     
-     ##Loop through starting locations
-     for n in  range(0,nstartloc):
-        #create list of starting latitudes, longitudes and heights.
-        self.slat.append(hdata2['s_lat'][n])
-        self.slon.append(hdata2['s_lon'][n])
-        self.sht.append(hdata2['s_ht'][n])
-
-        #try to guess century if century not given
-        if century == 0:
-           if hdata2['r_year'][0] < 50:
-              century = 2000
-           else:
-              century= 1900
-        ##add sourcedate which is datetime.datetime object
-        self.sourcedate.append(datetime.datetime(century+hdata2['r_year'][n] , \
-                            hdata2['r_month'][n] , hdata2['r_day'][n] , \
-                            hdata2['r_hr'][n], hdata2['r_min'][n]))
-     
-     #read record 4 which gives information about vertical levels.
-     hdata4a=np.fromfile(fp,dtype=rec4a, count=1)                  #gets nmber of levels
-     hdata4b=np.fromfile(fp,dtype=rec4b, count=hdata4a['nlev'][0]) #reads levels, count is number of levels.
-     self.levels = hdata4b['levht']
-
-     #read record 5 which gives information about pollutants / species.
-     hdata5a=np.fromfile(fp,dtype=rec5a, count=1)
-     hdata5b=np.fromfile(fp,dtype=rec5b, count=hdata5a['pollnum'][0])
-     hdata5c=np.fromfile(fp,dtype=rec5c, count=1)
-
      if verbose:
          print('REC1 ***************************************')
          print('pad, MetId, Met starting time (year, month, day, hour, forecast-hour), number starting loc., packing flag')
-         print(hdata1)
+         print(self.cmap.hdata1)
          print('REC 2 **************************************')
          print('Release start time (year, month, day, hour), start location (lat, lon, height), release start time (minutes)')
-         print(hdata2) 
+         print(self.cmap.hdata2) 
          print('REC 3 **************************************')
-         print(hdata3) 
+         print(self.cmap.hdata3) 
          print('REC 4 **************************************')
-         print(hdata4a)
-         print(hdata4b)
-         print('nlev', hdata4a['nlev'])
-         print('height of levels' , hdata4b['levht'])
+         print('nlev', len(self.levels))
+         print('height of levels' , self.levels)
          print('REC 5 **************************************')
-         print(hdata5a)
-         print(hdata5b)
-         print(hdata5c)
-         print('number of pollutants', hdata5a['pollnum'])
+         print('number of pollutants', len(self.cmap.pollutants))
+         print('pollutants', self.cmap.pollutants)
 
      #Loop to reads records 6-8. Number of loops is equal to number of output times.
      #Only save data for output times within drange. if drange=[] then save all.
      ##Loop to go through each sampling time
-     ii=0
      iii=0
-     imax = 1e3 #Safety valve - will not allow more than 1000 loops to be executed.
-     testf=True
-     while testf:
-        hdata6=np.fromfile(fp,dtype=rec6, count=1)
-        hdata7=np.fromfile(fp,dtype=rec6, count=1)
-        if len(hdata6) == 0:       #if no data read then break out of the while loop.
-           break
+     for pdate1, pdate2, records in self.cmap.iter_periods(species=self.select_species, levels=self.select_levels):
         if verbose:
             print('REC 6 & 7 ***************')
-            print(hdata6)
-            print(hdata7)
+            print(pdate1, pdate2)
         #pdate1 is the sample start
         #pdate2 is the sample stop
-        pdate1 = datetime.datetime(century+hdata6['oyear'], hdata6['omonth'], hdata6['oday'], hdata6['ohr'])
-        pdate2 = datetime.datetime(century+hdata7['oyear'], hdata7['omonth'], hdata7['oday'], hdata7['ohr'])
-        savedata=True
         pdatea = pd.Timestamp(pdate1)
         pdateb = pd.Timestamp(pdate2)
-        tdelta = pdateb -pdateb
 
         #if pdate1 is within drange then save the data.
         #AND if pdate2 is within drange then save the data.
         #if drange[0] > pdate1 then stop looping to look for more data
         ##this block sets savedata to true if data within specified time range or time range not specified
-        if drange ==[]:
-           savedata=True
-           ii=0
-        elif pdate1 >= drange[0] and pdate1 <= drange[1] and pdate2 <= drange[1]:
-           savedata=True
-           ii=0
-        elif pdate1 > drange[1] or pdate2 > drange[1]:
-           testf=False
-           savedata=False
-        else:
-           savedata=False
+        savedata, testf = self._test_dates(pdate1, pdate2, drange)
+        if not testf:
+           break
         ##END block
 
-          
         if verbose: 
            print(savedata , 'DATES :' , pdate1 , pdate2) 
         if savedata:
            self.pdates.append((pdate1,pdate2))  #add sample start and sample stop time to pdates list.
 
-        datelist = [] 
-        inc_iii=False
- 
-        ##LOOP to go through each level
-        for lev in range(hdata4a['nlev'][0]):
-            ##LOOP to go through each pollutant
-            for pollutant in range(hdata5a['pollnum'][0]):
-                ##record 8a has the number of elements (ne). If number of elements greater than 0 than there are concentrations.
-                hdata8a=np.fromfile(fp,dtype=rec8a, count=1)
-                
-                if hdata8a['ne'] >= 1:  #if number of elements is nonzero then
-                   hdata8b = np.fromfile(fp,dtype=rec8b, count=hdata8a['ne'][0]) #get rec8 - indx and jndx
-                   self.nonzeroconcdates.append(pdate1)                          #add sample start time to list of start times with non zero conc
-                else:
-                   tempzeroconcdates.append(pdate1)                              #or add sample start time to list of start times with zero conc.
-                hdata8c=np.fromfile(fp,dtype=rec8c, count=1)
-
-                ##if savedata is set and nonzero concentrations then save the data in a pandas dataframe
-                if savedata and hdata8a['ne'] >=1: 
-                   #self.nonzeroconcdates.append(pdate1)
-                   inc_iii=True  #set to True to indicate that there is data to be saved.
-                   #create column name for data
-                   col_name = self._col_name(hdata8a['poll'][0].decode('UTF-8'), hdata8a['lev'][0]) 
-                   if col_name not in self.conc_names:
-                       self.conc_names.append(col_name)
-                       if verbose: print('appending column name' , col_name)
-                   if hdata8a['poll'][0].decode('UTF-8') not in self.species:
-                       if verbose: print('appending species' , hdata8a['poll'][0])
-                       self.species.append(hdata8a['poll'][0].decode('UTF-8'))
-                          
-                   ndata = hdata8b.byteswap().newbyteorder()  #otherwise get endian error.
-                   if ii==0:  #if this is the first time through. create dataframe for first level and pollutant.
-                      concframe = pd.DataFrame.from_records(ndata)
-                      concframe.rename(columns={'conc':col_name}, inplace=True)
-                   else:     #create dataframe for level and pollutant and then merge with main dataframe.
-                      concframe2 = pd.DataFrame.from_records(ndata)
-                      concframe2.rename(columns={'conc':col_name}, inplace=True)
-                      concframe =  pd.merge(concframe, concframe2, how='outer', on=['jndx','indx'])
-                   ii+=1
-                if verbose:
-                    print('REC 8 **************************************')
-                    print(hdata8a)
-            ##END LOOP to go through each pollutant
-        ##END LOOP to go through each level
-        if ii > imax:  #safety check - will stop sampling time while loop if goes over imax iterations.
-           testf=False
-        if inc_iii:
+        ii=0
+        ##LOOP to go through each level and pollutant record.
+        for poll, lev, cview in records:
+            ##cview is the rec8b view - indx, jndx, conc. If it has elements than there are concentrations.
+            if cview.shape[0] >= 1:
+               self.nonzeroconcdates.append(pdate1)   #add sample start time to list of start times with non zero conc
+            else:
+               tempzeroconcdates.append(pdate1)       #or add sample start time to list of start times with zero conc.
+
+            ##if savedata is set and nonzero concentrations then save the data in a pandas dataframe
+            if savedata and cview.shape[0] >= 1: 
+               #create column name for data
+               col_name = self._col_name(poll, lev) 
+               if col_name not in self.conc_names:
+                   self.conc_names.append(col_name)
+                   if verbose: print('appending column name' , col_name)
+               if poll not in self.species:
+                   if verbose: print('appending species' , poll)
+                   self.species.append(poll)
+                      
+               ndata = cview.astype(cview.dtype.newbyteorder('='))  #otherwise get endian error.
+               if ii==0:  #if this is the first time through. create dataframe for first level and pollutant.
+                  concframe = pd.DataFrame.from_records(ndata)
+                  concframe.rename(columns={'conc':col_name}, inplace=True)
+               else:     #create dataframe for level and pollutant and then merge with main dataframe.
+                  concframe2 = pd.DataFrame.from_records(ndata)
+                  concframe2.rename(columns={'conc':col_name}, inplace=True)
+                  concframe =  pd.merge(concframe, concframe2, how='outer', on=['jndx','indx'])
+               ii+=1
+            if verbose:
+                print('REC 8 **************************************')
+                print(poll, lev, cview.shape[0])
+        ##END LOOP to go through each level and pollutant record.
+        if ii > 0:
+            concframe['sdate'] = pdatea #create column sdate which is sampling start time
+            concframe['edate'] = pdateb #create column edate which is sampling stop time
             if iii==0:  
                 #if first time through sampling time loop then create final dataframe.
                 concframe3 = concframe
-                concframe3['sdate'] = pdatea #create column sdate which is sampling start time
-                concframe3['edate'] = pdateb #create column edate which is sampling stop time
             else:
                 ##add the next sampling time onto the final dataframe.
-                #print '******concat*************' , pdatea , '  time' , str(iii)
-                concframe['sdate'] = pdatea
-                concframe['edate'] = pdateb
                 concframe3 = pd.concat([concframe3, concframe])
-            if inc_iii: 
-                iii+=1
+            iii+=1
 
      ##END OF Loop to go through each sampling time
 
@@ -565,17 +1549,746 @@ class ModelBin(object):
      self.edate = self.pdates[-1][1]
 
      ##add latitude longitude columns
-     lat = np.arange(self.llcrnr_lat, self.llcrnr_lat+ self.nlat * self.dlat, self.dlat)
-     lon = np.arange(self.llcrnr_lon, self.llcrnr_lon+ self.nlon * self.dlon, self.dlon)
-     flat = lambda x : lat[x-1]
-     flon = lambda x : lon[x-1]
-     self.concframe['lat'] = self.concframe['jndx'].apply(flat)
-     self.concframe['lon'] = self.concframe['indx'].apply(flon)
+     lat, lon = self._latlon_axes()
+     self.concframe['lat'] = lat[self.concframe['jndx'].values - 1]
+     self.concframe['lon'] = lon[self.concframe['indx'].values - 1]
 
      for dt in tempzeroconcdates:
          if dt not in self.nonzeroconcdates:
             self.zeroconcdates.append(dt)
 
-     return True 
+     return True
+
+
+
+  def _readcompact(self):
+     """Data from the file is stored in a pandas dataframe (self.concframe) with the same rows and columns
+        as created by _readfile but with compact data types.
+        concentrations are float32 (NaN where a level and pollutant has no concentration in a grid cell),
+        indx and jndx are int16, lat and lon are float32 and sdate (index) and edate are categorical.
+        For each sampling period the grid cells of all the records are found with np.unique and each
+        record is put into its column by np.searchsorted, so there are no dataframe merges.
+        The columns are filled as numpy arrays and the dataframe is created once at the end.
+        returns False if all concentrations are zero else returns True."""
+     self.pdates = []
+     self.cmap = None
+     self._open()
+     tempzeroconcdates = []
+     cells = []      #grid cells (jndx-1) * nlon + (indx-1) with concentrations for each sampling period.
+     periods = []    #(sample start, sample stop) for each item in cells.
+     columns = {}    #key is column name. value is list of (item in cells, rows, conc).
+     for pdate1, pdate2, records in self.cmap.iter_periods(species=self.select_species, levels=self.select_levels):
+         savedata, testf = self._test_dates(pdate1, pdate2, self.drange)
+         if not testf:
+            break
+         if savedata:
+            self.pdates.append((pdate1, pdate2))
+         nonzero = []
+         for poll, lev, cview in records:
+             if cview.shape[0] >= 1:
+                self.nonzeroconcdates.append(pdate1)
+                nonzero.append((poll, lev, cview))
+             else:
+                tempzeroconcdates.append(pdate1)
+         if not savedata or not nonzero:
+            continue
+         keys = [(cview['jndx'].astype(np.int32) - 1) * self.nlon + cview['indx'] - 1 for poll, lev, cview in nonzero]
+         pcells = np.unique(np.concatenate(keys))
+         for (poll, lev, cview), key in zip(nonzero, keys):
+             col_name = self._col_name(poll, lev)
+             if col_name not in self.conc_names:
+                self.conc_names.append(col_name)
+                columns[col_name] = []
+             if poll not in self.species:
+                self.species.append(poll)
+             columns[col_name].append((len(cells), np.searchsorted(pcells, key), cview['conc']))
+         cells.append(pcells)
+         periods.append((pdate1, pdate2))
+     if not cells:
+        print('Warning: ModelBin class _readcompact method: no data in the date range found')
+        return False
+     start = np.concatenate(([0], np.cumsum([len(pcells) for pcells in cells])))
+     allcells = np.concatenate(cells)
+     jndx = (allcells // self.nlon).astype(np.int16) + 1
+     indx = (allcells % self.nlon).astype(np.int16) + 1
+     frame = {'indx': indx, 'jndx': jndx}
+     for col_name in self.conc_names:
+         conc = np.full(start[-1], np.nan, dtype=np.float32)
+         for ppp, rows, cview in columns[col_name]:
+             conc[start[ppp] + rows] = cview
+         frame[col_name] = conc
+     codes = np.repeat(np.arange(len(cells)), np.diff(start))
+     frame['sdate'] = pd.Categorical.from_codes(codes, categories=pd.DatetimeIndex([pdate[0] for pdate in periods]))
+     frame['edate'] = pd.Categorical.from_codes(codes, categories=pd.DatetimeIndex([pdate[1] for pdate in periods]))
+     frame['idx'] = np.arange(start[-1], dtype=np.int32)
+     lat, lon = self._latlon_axes()
+     concframe = pd.DataFrame(frame)
+     concframe.set_index(['sdate', 'idx'], inplace=True)
+     concframe['lat'] = lat.astype(np.float32)[jndx - 1]
+     concframe['lon'] = lon.astype(np.float32)[indx - 1]
+     self.concframe = concframe
+     self.sdate = self.pdates[0][0]
+     self.edate = self.pdates[-1][1]
+     for dt in tempzeroconcdates:
+         if dt not in self.nonzeroconcdates:
+            self.zeroconcdates.append(dt)
+     if self.verbose:
+        print('memory usage (bytes)', self.memory_usage())
+     return True
+
+  def memory_usage(self):
+      """returns dictionary with the number of bytes used by the file ('file'), self.concframe ('concframe'),
+         self.cube ('cube') and the ratio of concframe + cube to the file size ('ratio').
+         concframe is 0 if the dataframe has not been created."""
+      usage = {'file': os.path.getsize(self.filename) if os.path.isfile(self.filename) else 0}
+      usage['concframe'] = 0
+      if self._concframe is not None:
+         usage['concframe'] = int(self._concframe.memory_usage(index=True, deep=True).sum())
+      usage['cube'] = 0
+      if self.cube is not None:
+         usage['cube'] = int(self.cube.nbytes)
+      usage['ratio'] = 0
+      if usage['file'] > 0:
+         usage['ratio'] = (usage['concframe'] + usage['cube']) / float(usage['file'])
+      return usage
+
+
+
+def _cube_summary(model):
+    """returns dictionary with the grid, sampling periods, levels, pollutants and cube of a ModelBin object"""
+    levels, pollutants = model._axes()
+    return {'filename': model.filename,
+            'grid': model._grid(),
+            'pdates': model.pdates,
+            'levels': levels,
+            'pollutants': pollutants,
+            'cube': model.cube}
+
+
+def _read_cube(args):
+    """reads a cdump file with storage='cube' and returns _cube_summary.
+       args is (filename, drange, species, levels). Used by ModelBin.add_conc in worker processes."""
+    filename, drange, species, levels = args
+    model = ModelBin(filename, cdir='', drange=drange, storage='cube', species=species, levels=levels)
+    return _cube_summary(model)
+
+
+def _add_cube(total, summary):
+    """adds the cube in summary (see _cube_summary) to the dictionary total.
+       key is (sample start, sample stop, poll, lev). value is float32 2d array (nlat, nlon)."""
+    for t, pdate in enumerate(summary['pdates']):
+        for k, lev in enumerate(summary['levels']):
+            for p, poll in enumerate(summary['pollutants']):
+                key = (pdate[0], pdate[1], poll, int(lev))
+                if key in total:
+                   total[key] += summary['cube'][t, k, p]
+                else:
+                   total[key] = summary['cube'][t, k, p].copy()
+
+
+def _add_records(total, model):
+    """adds the concentrations of a ModelBin which has neither cube nor concframe (e.g. readwrite='s')
+       to the dictionary total (see _add_cube). The records of each sampling period are read from the file
+       (see _records)."""
+    for pdate in model.pdates:
+        for (poll, lev), (indx, jndx, conc) in model._records(pdate[0]).items():
+            key = (pdate[0], pdate[1], poll, int(lev))
+            if key not in total:
+               total[key] = np.zeros((int(model.nlat), int(model.nlon)), dtype=np.float32)
+            total[key][jndx - 1, indx - 1] += conc
+
+
+_regrid_cache = {}   #overlap weight matrices used by ModelBin.regrid. key is (source grid, target grid).
+
+EARTH_RADIUS = 6371000.0   #meters
+
+
+def _lon_index(lon, llcrnr_lon, dlon):
+    """returns float array of the position of longitudes lon on a grid, in grid cells east of llcrnr_lon.
+       The longitude offset is wrapped into [-dlon / 2, 360 - dlon / 2) so points just west of the first
+       column are not 360 degrees east, and grids which cross 180 or are global work.
+       Used by ModelBin._point_index and pardump/pargrid.py."""
+    return ((np.asarray(lon, dtype=float) - float(llcrnr_lon) + dlon / 2.0) % 360.0 - dlon / 2.0) / float(dlon)
+
+
+def _global_lon(nlon, dlon):
+    """returns True if a grid with nlon columns dlon degrees apart goes all the way around the globe."""
+    return abs(int(nlon) * float(dlon) - 360.0) < float(dlon) / 2.0
+
+
+def _cell_area(nlat, dlat, llcrnr_lat, dlon):
+    """returns 1d array (nlat) of the area in square meters of the grid cells in each row of a lat-lon grid.
+       Area is proportional to the integral of cos(lat) over the cell."""
+    edges = np.radians(np.clip(llcrnr_lat + (np.arange(nlat + 1) - 0.5) * dlat, -90, 90))
+    return EARTH_RADIUS**2 * np.radians(dlon) * np.diff(np.sin(edges))
+
+
+def _overlap(src_edges, tgt_edges, fn=None):
+    """returns dense array (target cells, source cells) of the length of overlap of 1d cells with the edges given.
+       if fn is given the length is measured as fn(edge) (np.sin for latitude)."""
+    low = np.maximum(tgt_edges[:-1, np.newaxis], src_edges[np.newaxis, :-1])
+    high = np.minimum(tgt_edges[1:, np.newaxis], src_edges[np.newaxis, 1:])
+    if fn is not None:
+       return np.where(high > low, fn(high) - fn(low), 0)
+    return np.where(high > low, high - low, 0)
+
+
+def _regrid_weights(source, target):
+    """returns scipy.sparse csr matrix (target nlat * nlon, source nlat * nlon) of weights for conservative
+       regridding. source and target are (nlat, nlon, dlat, dlon, llcrnr_lat, llcrnr_lon).
+       Weight is area of overlap of the target and source cells divided by the area of the target cell.
+       The grids are rectangular in lat-lon so the matrix is the kronecker product of the latitude and
+       longitude overlaps. Matrices are cached in _regrid_cache."""
+    from scipy import sparse   #scipy is only needed for regridding.
+    key = (source, target)
+    if key not in _regrid_cache:
+       snlat, snlon, sdlat, sdlon, slat, slon = source
+       tnlat, tnlon, tdlat, tdlon, tlat, tlon = target
+       #put the target longitudes within 180 degrees of the source longitudes.
+       tlon = tlon - 360.0 * np.round((tlon - slon) / 360.0)
+       sedge = np.radians(np.clip(slat + (np.arange(snlat + 1) - 0.5) * sdlat, -90, 90))
+       tedge = np.radians(np.clip(tlat + (np.arange(tnlat + 1) - 0.5) * tdlat, -90, 90))
+       tarea = np.diff(np.sin(tedge))
+       olat = _overlap(sedge, tedge, np.sin) / np.where(tarea > 0, tarea, 1)[:, np.newaxis]
+       sedge = slon + (np.arange(snlon + 1) - 0.5) * sdlon
+       tedge = tlon + (np.arange(tnlon + 1) - 0.5) * tdlon
+       olon = _overlap(sedge, tedge) / tdlon
+       _regrid_cache[key] = sparse.kron(sparse.csr_matrix(olat), sparse.csr_matrix(olon), format='csr')
+    return _regrid_cache[key]
+
+
+class CdumpMap(object):
+  """memory mapped view of a binary cdump file.
+     The file is mapped once and the fortran record markers (the 4 byte record lengths which
+     begin and end each record) are walked to find the byte offset of each record.
+     Concentration records (rec8b in ModelBin.define_struct) are returned as zero-copy numpy views into the map.
+     The views are big endian and read only. Use astype to get a native copy.
+     Only packed cdump files (conc_pack=1) are supported.
 
+     methods:
+     record - returns start and end of the data in the record which begins at an offset.
+     remap - maps the file again if it has grown.
+     conc_view - returns the rec8b view for the record 8 which begins at an offset.
+     iter_periods - generator which yields the sample start, sample stop and
+                    the concentration views for each sampling period.
+     scan - builds an index of byte offsets of the concentration records without reading the concentrations.
+     records - returns the concentration views for one sampling period using the index.
+     save_index, load_index - write / read the index to / from a sidecar file.
+
+     attributes:
+     header information from records 1-5 - nlat, nlon, dlat, dlon, llcrnr_lat, llcrnr_lon, metmodel, metdate,
+     sourcedate, slat, slon, sht, levels, pollutants (list of pollutant identifiers) and century.
+     hdata1, hdata2, hdata3 - numpy records 1-3.
+     data_start - byte offset of the first record 6.
+     last_offset - byte offset following the last complete sampling period found by iter_periods or scan.
+     index - index of the concentration records built by scan. None until scan or load_index is called.
+     forecast - dictionary. key is sample start. value is (forecast hour of sample start, forecast hour of sample stop)
+                for each sampling period walked by iter_periods or scan.
+  """
 
+  index_dtype = np.dtype([('sdate'  , 'M8[m]'),
+                          ('edate'  , 'M8[m]'),
+                          ('poll'   , 'U4'),
+                          ('lev'    , 'i4'),
+                          ('offset' , 'i8'),
+                          ('ne'     , 'i4'),
+                         ])
+
+  def __init__(self, filename, century=0):
+      self.filename = filename
+      self.mm = np.memmap(filename, dtype=np.uint8, mode='r')
+      self.century = century
+      self.index = None
+      self.forecast = {}     #key is sample start. value is forecast hours of sample start and stop (records 6 and 7)
+      structs = ModelBin.define_struct()
+      self._rec6 = structs[8]
+      self._rec8a = structs[9]
+      self._rec8b = structs[10]
+      self._readheader()
+
+  def record(self, offset):
+      """returns (start, end) byte offsets of the data in the fortran record which begins at offset.
+         The next record begins at end + 4.
+         Raises IOError if the record is not complete."""
+      if offset + 4 > self.mm.shape[0]:
+         raise IOError('CdumpMap: no record at offset ' + str(offset) + ' in ' + self.filename)
+      nbytes = int(np.frombuffer(self.mm, dtype='>i4', count=1, offset=offset)[0])
+      start = offset + 4
+      end = start + nbytes
+      if nbytes < 0 or end + 4 > self.mm.shape[0]:
+         raise IOError('CdumpMap: incomplete record at offset ' + str(offset) + ' in ' + self.filename)
+      if int(np.frombuffer(self.mm, dtype='>i4', count=1, offset=end)[0]) != nbytes:
+         raise IOError('CdumpMap: record markers do not match at offset ' + str(offset) + ' in ' + self.filename)
+      return start, end
+
+  def remap(self):
+      """maps the file again if it has grown since it was mapped, so that records which have been
+         added can be read. Views returned before stay valid. returns True if the file has grown."""
+      if os.path.getsize(self.filename) <= self.mm.shape[0]:
+         return False
+      self.mm = np.memmap(self.filename, dtype=np.uint8, mode='r')
+      return True
+
+  def _readheader(self):
+      """reads records 1-5"""
+      rec1, rec2, rec3, rec4a, rec4b, rec5a, rec5b, rec5c, rec6, rec8a, rec8b, rec8c = ModelBin.define_struct()
+      self.hdata1 = np.frombuffer(self.mm, dtype=rec1, count=1, offset=0)
+      nstartloc = self.hdata1['start_loc'][0]
+      start, end = self.record(0)
+      offset = end + 4
+      self.hdata2 = np.frombuffer(self.mm, dtype=rec2, count=nstartloc, offset=offset)
+      for n in range(0, nstartloc):
+          start, end = self.record(offset)
+          offset = end + 4
+      self.hdata3 = np.frombuffer(self.mm, dtype=rec3, count=1, offset=offset)
+      start, end = self.record(offset)
+      offset = end + 4
+      self.nlat = self.hdata3['nlat'][0]
+      self.nlon = self.hdata3['nlon'][0]
+      self.dlat = self.hdata3['dlat'][0]
+      self.dlon = self.hdata3['dlon'][0]
+      self.llcrnr_lon = self.hdata3['llcrnr_lon'][0]
+      self.llcrnr_lat = self.hdata3['llcrnr_lat'][0]
+      self.metmodel = self.hdata1['model_id'][0].decode('UTF-8')
+
+      #record 4 - vertical levels
+      hdata4a = np.frombuffer(self.mm, dtype=rec4a, count=1, offset=offset)
+      hdata4b = np.frombuffer(self.mm, dtype=rec4b, count=hdata4a['nlev'][0], offset=offset+8)
+      self.levels = hdata4b['levht'].astype(int)
+      start, end = self.record(offset)
+      offset = end + 4
+
+      #record 5 - pollutants
+      start, end = self.record(offset)
+      pollnum = int(np.frombuffer(self.mm, dtype='>i4', count=1, offset=start)[0])
+      hdata5b = np.frombuffer(self.mm, dtype=rec5b, count=pollnum, offset=start+4)
+      self.pollutants = [x.decode('UTF-8') for x in hdata5b['pname']]
+      self.data_start = end + 4
+      self.last_offset = self.data_start
+
+      self.sourcedate=[]
+      self.slat=[]
+      self.slon=[]
+      self.sht=[]
+      for n in range(0, nstartloc):
+         self.slat.append(self.hdata2['s_lat'][n])
+         self.slon.append(self.hdata2['s_lon'][n])
+         self.sht.append(self.hdata2['s_ht'][n])
+         #try to guess century if century not given
+         if self.century == 0:
+            if self.hdata2['r_year'][0] < 50:
+               self.century = 2000
+            else:
+               self.century= 1900
+         self.sourcedate.append(datetime.datetime(self.century + int(self.hdata2['r_year'][n]),
+                                int(self.hdata2['r_month'][n]), int(self.hdata2['r_day'][n]),
+                                int(self.hdata2['r_hr'][n]), int(self.hdata2['r_min'][n])))
+      try:
+         self.metdate = datetime.datetime(self.century + int(self.hdata1['met_year'][0]), int(self.hdata1['met_month'][0]),
+                                          int(self.hdata1['met_day'][0]), int(self.hdata1['met_hr'][0]))
+      except ValueError:
+         self.metdate = None
+
+  def _pdate(self, offset):
+      """returns (datetime object, forecast hour) from record 6 or 7 which begins at offset"""
+      hdata = np.frombuffer(self.mm, dtype=self._rec6, count=1, offset=offset)
+      pdate = datetime.datetime(self.century + int(hdata['oyear'][0]), int(hdata['omonth'][0]),
+                                int(hdata['oday'][0]), int(hdata['ohr'][0]), int(hdata['omin'][0]))
+      return pdate, int(hdata['oforecast'][0])
+
+  def conc_view(self, offset):
+      """returns (poll, lev, view) for the record 8 which begins at offset.
+         view is a zero-copy numpy array with dtype rec8b (indx, jndx, conc)."""
+      start, end = self.record(offset)
+      hdata8a = np.frombuffer(self.mm, dtype=self._rec8a, count=1, offset=offset)
+      ne = max(int(hdata8a['ne'][0]), 0)
+      cview = np.frombuffer(self.mm, dtype=self._rec8b, count=ne, offset=start+12)
+      return hdata8a['poll'][0].decode('UTF-8'), int(hdata8a['lev'][0]), cview
+
+  def _walk(self, offset=None):
+      """generator which walks the sampling periods (records 6, 7 and 8) beginning at offset
+         (default is the first sampling period) using only the record markers.
+         yields (sample start, sample stop, list of offsets of the record 8s in the period).
+         Stops at the end of the file or at a sampling period which is not complete.
+         self.last_offset is set to the offset following the last complete sampling period."""
+      if offset is None:
+         offset = self.data_start
+      nrec = len(self.levels) * len(self.pollutants)
+      while offset < self.mm.shape[0]:
+          try:
+              start, end = self.record(offset)
+              pdate1, fhr1 = self._pdate(offset)
+              offset2 = end + 4
+              start, end = self.record(offset2)
+              pdate2, fhr2 = self._pdate(offset2)
+              roffset = end + 4
+              roffsets = []
+              for nnn in range(nrec):
+                  roffsets.append(roffset)
+                  start, end = self.record(roffset)
+                  roffset = end + 4
+          except IOError:
+              break
+          offset = roffset
+          self.last_offset = offset
+          self.forecast[pdate1] = (fhr1, fhr2)
+          yield pdate1, pdate2, roffsets
+
+  def iter_periods(self, offset=None, species=None, levels=None):
+      """generator which walks the sampling periods (records 6, 7 and 8) beginning at offset
+         (default is the first sampling period).
+         yields (sample start, sample stop, records) where records is a list of (poll, lev, view)
+         with one entry for each level and pollutant.
+         species - list of pollutant identifiers. if not None then records for other pollutants are skipped.
+         levels - list of levels. if not None then records for other levels are skipped.
+         Stops at the end of the file or at a sampling period which is not complete.
+         self.last_offset is set to the offset following the last complete sampling period."""
+      for pdate1, pdate2, roffsets in self._walk(offset):
+          records = []
+          for roffset in roffsets:
+              if species is not None or levels is not None:
+                 hdata8a = np.frombuffer(self.mm, dtype=self._rec8a, count=1, offset=roffset)
+                 if species is not None and hdata8a['poll'][0].decode('UTF-8') not in species:
+                    continue
+                 if levels is not None and hdata8a['lev'][0] not in levels:
+                    continue
+              records.append(self.conc_view(roffset))
+          yield pdate1, pdate2, records
+
+  def scan(self, offset=None):
+      """reads only records 6, 7 and the header of each record 8 (rec8a), skipping the concentration data.
+         Builds self.index, a numpy structured array (dtype CdumpMap.index_dtype) with one row for each record 8.
+         fields are sdate, edate (sample start and stop), poll, lev, offset (byte offset of the record 8) and
+         ne (number of elements).
+         If offset is given the sampling periods from offset onward are appended to self.index.
+         returns self.index"""
+      rows = []
+      for pdate1, pdate2, roffsets in self._walk(offset):
+          for roffset in roffsets:
+              hdata8a = np.frombuffer(self.mm, dtype=self._rec8a, count=1, offset=roffset)
+              rows.append((pdate1, pdate2, hdata8a['poll'][0].decode('UTF-8'), hdata8a['lev'][0],
+                           roffset, max(hdata8a['ne'][0], 0)))
+      index = np.array(rows, dtype=self.index_dtype)
+      if offset is None or self.index is None:
+         self.index = index
+      else:
+         self.index = np.concatenate([self.index, index])
+      return self.index
+
+  def records(self, sdate, species=None, levels=None):
+      """returns list of (poll, lev, view) for the sampling period which starts at sdate.
+         species - list of pollutant identifiers to return. if None returns all.
+         levels - list of levels to return. if None returns all.
+         Uses self.index (see scan) so only the records asked for are looked at."""
+      if self.index is None:
+         self.scan()
+      sel = self.index['sdate'] == np.datetime64(sdate, 'm')
+      if species is not None:
+         sel &= np.isin(self.index['poll'], species)
+      if levels is not None:
+         sel &= np.isin(self.index['lev'], levels)
+      return [self.conc_view(roffset) for roffset in self.index['offset'][sel]]
+
+  def _sidecar_name(self, fname):
+      if fname is None:
+         fname = self.filename + '.idx.npz'
+      return fname
+
+  def save_index(self, fname=None):
+      """saves self.index to a sidecar file (default is filename + '.idx.npz').
+         The size and modification time of the cdump file are saved with it."""
+      fname = self._sidecar_name(fname)
+      if self.index is None:
+         self.scan()
+      stat = os.stat(self.filename)
+      with open(fname, 'wb') as fid:
+          np.savez(fid, index=self.index, size=stat.st_size, mtime=stat.st_mtime_ns)
+      return fname
+
+  def load_index(self, fname=None):
+      """loads self.index from a sidecar file written by save_index.
+         returns False if the sidecar file does not exist or does not match the size and
+         modification time of the cdump file. Otherwise returns True."""
+      fname = self._sidecar_name(fname)
+      if not os.path.isfile(fname):
+         return False
+      stat = os.stat(self.filename)
+      with np.load(fname) as sidecar:
+          if int(sidecar['size']) != stat.st_size or int(sidecar['mtime']) != stat.st_mtime_ns:
+             return False
+          self.index = sidecar['index']
+      self.last_offset = self.data_start
+      if self.index.shape[0] > 0:
+         start, end = self.record(int(self.index['offset'][-1]))
+         self.last_offset = end + 4
+      return True
+
+
+
+class CachedMap(CdumpMap):
+  """CdumpMap for an entry of a CdumpCache (see CdumpCache.load).
+     The header is read from the cached bytes of records 1-5 and the concentration records are
+     slices of the cached record array instead of the file, so the ModelBin readers can use it
+     in place of a CdumpMap.
+     The offset field of index is the row of the record in index instead of a byte offset.
+     starts is the position of the first element of each record in the record array.
+  """
+
+  def __init__(self, filename, header, index, starts, conc, forecast, century=0):
+      self.filename = filename
+      self.mm = header
+      self.century = century
+      self.index = index
+      self.forecast = forecast
+      self._starts = starts
+      self._conc = conc
+      self._readheader()
+
+  def remap(self):
+      return False
+
+  def conc_view(self, offset):
+      """returns (poll, lev, view) for row offset of index. view is a slice of the record array."""
+      row = self.index[offset]
+      start = int(self._starts[offset])
+      return str(row['poll']), int(row['lev']), self._conc[start:start + int(row['ne'])]
+
+  def iter_periods(self, offset=None, species=None, levels=None):
+      """generator which yields (sample start, sample stop, records) for each sampling period
+         (see CdumpMap.iter_periods). offset is not used."""
+      nrec = len(self.levels) * len(self.pollutants)
+      if nrec == 0:
+         return
+      for first in range(0, self.index.shape[0], nrec):
+          rows = range(first, first + nrec)
+          if species is not None:
+             rows = [row for row in rows if self.index['poll'][row] in species]
+          if levels is not None:
+             rows = [row for row in rows if self.index['lev'][row] in levels]
+          yield (self.index['sdate'][first].astype(datetime.datetime),
+                 self.index['edate'][first].astype(datetime.datetime),
+                 [self.conc_view(row) for row in rows])
+
+  def scan(self, offset=None):
+      """returns self.index which was stored in the cache."""
+      return self.index
+
+
+
+class CdumpPeriod(object):
+  """concentrations for one sampling period of a cdump file. Created by ModelBin.iter_periods.
+     attributes:
+     sdate - sample start (datetime object)
+     edate - sample stop (datetime object)
+     records - dictionary. key is (poll, lev). value is numpy array with fields indx, jndx, conc
+               of the nonzero concentrations. Levels and pollutants with no concentrations are not included.
+     model - ModelBin object which describes the grid.
+     methods:
+     grid - returns 2d array (nlat, nlon) of concentration for one pollutant and level.
+     cube - returns array (level, pollutant, nlat, nlon) of concentration.
+     frame - returns pandas dataframe in the same form as ModelBin.concframe.
+  """
+
+  def __init__(self, model, sdate, edate, records):
+      self.model = model
+      self.sdate = sdate
+      self.edate = edate
+      self.records = {}
+      for poll, lev, cview in records:
+          if cview.shape[0] >= 1:
+             self.records[(poll, lev)] = cview
+
+  def grid(self, poll, lev):
+      """returns float32 2d array (nlat, nlon) of concentration for pollutant poll and level lev."""
+      conc2d = np.zeros((self.model.nlat, self.model.nlon), dtype=np.float32)
+      cview = self.records.get((poll, lev))
+      if cview is not None:
+         #need to subtract one because fortran arrays start at index 1 while python arrays start at index 0.
+         conc2d[cview['jndx'] - 1, cview['indx'] - 1] = cview['conc']
+      return conc2d
+
+  def cube(self):
+      """returns float32 array (level, pollutant, nlat, nlon) of concentration.
+         The axes correspond to the levels and pollutants returned by model._axes."""
+      levels, pollutants = self.model._axes()
+      kindex = dict((lev, k) for k, lev in enumerate(levels))
+      pindex = dict((poll, p) for p, poll in enumerate(pollutants))
+      cube = np.zeros((len(kindex), len(pindex), self.model.nlat, self.model.nlon), dtype=np.float32)
+      for (poll, lev), cview in self.records.items():
+          cube[kindex[lev], pindex[poll], cview['jndx'] - 1, cview['indx'] - 1] = cview['conc']
+      return cube
+
+  def frame(self):
+      """returns pandas dataframe with columns indx, jndx, a concentration column for each
+         level and pollutant (see ModelBin._col_name), sdate, edate, lat and lon.
+         Each row is a grid cell with a nonzero concentration for at least one level and pollutant."""
+      nkey = self.model.nlon + 1
+      keys = {}
+      for key, cview in self.records.items():
+          keys[key] = cview['jndx'].astype(np.int64) * nkey + cview['indx']
+      if keys:
+         cells = np.unique(np.concatenate(list(keys.values())))
+      else:
+         cells = np.zeros(0, dtype=np.int64)
+      frame = pd.DataFrame({'indx': (cells % nkey).astype(np.int16), 'jndx': (cells // nkey).astype(np.int16)})
+      for key, cview in self.records.items():
+          conc = np.full(cells.shape[0], np.nan, dtype=np.float32)
+          conc[np.searchsorted(cells, keys[key])] = cview['conc']
+          frame[self.model._col_name(key[0], key[1])] = conc
+      frame['sdate'] = pd.Timestamp(self.sdate)
+      frame['edate'] = pd.Timestamp(self.edate)
+      lat, lon = self.model._latlon_axes()
+      frame['lat'] = lat[frame['jndx'].values - 1]
+      frame['lon'] = lon[frame['indx'].values - 1]
+      return frame
+
+
+
+class CdumpCache(object):
+  """on disk cache of decoded cdump files. Used by ModelBin when the cache argument is given.
+     Each entry is two files in the cache directory.
+     key.npy - the concentration records (indx, jndx, conc) of the file in native byte order, one after another.
+               It is memory mapped (read only) when loaded.
+     key.npz - the bytes of the header (records 1-5), the record index (see CdumpMap.scan) with the
+               position of each record in key.npy, and the forecast hours of the sampling periods.
+     The entry holds every record of the file, so it is used whatever drange, species, levels and storage
+     the file is read with. ModelBin builds its storage from the entry with a CachedMap.
+     Entries are written to temporary files with unique names which are then renamed, so several processes
+     can store the same entry at once.
+     The key is made from the path, size and modification time of the cdump file (and a hash of its
+     contents if hash=True) and the century used to read it.
+     When the total size of the entries is more than max_bytes, the least recently used entries are removed.
+     methods:
+     key - returns the key for a ModelBin object.
+     load - sets a ModelBin object up to read from the cache.
+     store - stores the records of the file read by a ModelBin object in the cache.
+     evict - removes least recently used entries until the cache is smaller than max_bytes.
+  """
+
+  record_dtype = np.dtype([('indx', 'i2'), ('jndx', 'i2'), ('conc', 'f4')])
+  tmp_age = 3600    #seconds after which a temporary file is taken to be left over from a store which failed.
+
+  def __init__(self, cdir, max_bytes=4 * 1024**3, hash=False):
+      self.cdir = cdir
+      self.max_bytes = max_bytes
+      self.hash = hash
+      if not os.path.isdir(cdir):
+         os.makedirs(cdir)
+
+  def key(self, model):
+      """returns the cache key for the file and century of a ModelBin object"""
+      stat = os.stat(model.filename)
+      keystr = '|'.join([os.path.abspath(model.filename), str(stat.st_size), str(stat.st_mtime_ns),
+                         str(model.century)])
+      if self.hash:
+         sha = hashlib.sha1()
+         with open(model.filename, 'rb') as fid:
+             for chunk in iter(lambda: fid.read(2**24), b''):
+                 sha.update(chunk)
+         keystr += '|' + sha.hexdigest()
+      return hashlib.sha1(keystr.encode('UTF-8')).hexdigest()
+
+  def _names(self, key):
+      return os.path.join(self.cdir, key + '.npy'), os.path.join(self.cdir, key + '.npz')
+
+  @staticmethod
+  def _dates(dates):
+      """list of datetime objects to numpy datetime64 array"""
+      return np.array([np.datetime64(dt, 's') for dt in dates], dtype='M8[s]')
+
+  @staticmethod
+  def _datetimes(dates):
+      """numpy datetime64 array to list of datetime objects"""
+      return [dt.astype(datetime.datetime) for dt in dates]
+
+  def load(self, model, key=None):
+      """sets model._cachemap to a CachedMap for the entry so that the ModelBin readers read from the cache.
+         key - cache key. if None then it is computed with the key method.
+         returns False if the file is not in the cache."""
+      if key is None:
+         key = self.key(model)
+      recname, metaname = self._names(key)
+      if not (os.path.isfile(recname) and os.path.isfile(metaname)):
+         return False
+      with np.load(metaname) as meta:
+          if 'index' not in meta.files:     #entry written by an older version.
+             return False
+          header = meta['header']
+          index = meta['index']
+          starts = meta['starts']
+          forecast = dict((sdate, (int(fhrs[0]), int(fhrs[1])))
+                          for sdate, fhrs in zip(self._datetimes(meta['fsdates']), meta['fhours']))
+      conc = np.load(recname, mmap_mode='r')
+      model._cachemap = CachedMap(model.filename, header, index, starts, conc, forecast, century=model.century)
+      os.utime(metaname)   #most recently used
+      return True
+
+  def store(self, model, key=None):
+      """stores the records of the file read by a ModelBin object (model.cmap) in the cache
+         then removes old entries if the cache is larger than max_bytes.
+         The records are copied one at a time into the memory mapped entry.
+         key - cache key. if None then it is computed with the key method."""
+      if key is None:
+         key = self.key(model)
+      recname, metaname = self._names(key)
+      cmap = model.cmap
+      index = cmap.index
+      if index is None:
+         index = cmap.scan()
+      index = index.copy()
+      ne = index['ne'].astype(np.int64)
+      starts = np.cumsum(ne) - ne
+      handle, tmpname = tempfile.mkstemp(prefix=key, suffix='.tmp', dir=self.cdir)
+      os.close(handle)
+      conc = np.lib.format.open_memmap(tmpname, mode='w+', dtype=self.record_dtype, shape=(int(ne.sum()),))
+      for row, offset in enumerate(index['offset']):
+          poll, lev, cview = cmap.conc_view(int(offset))
+          conc[starts[row]:starts[row] + ne[row]] = cview
+      conc.flush()
+      del conc
+      os.replace(tmpname, recname)
+      index['offset'] = np.arange(index.shape[0])
+      fsdates = sorted(cmap.forecast)
+      handle, tmpname = tempfile.mkstemp(prefix=key, suffix='.tmp', dir=self.cdir)
+      with os.fdopen(handle, 'wb') as fid:
+          np.savez(fid, header=np.array(cmap.mm[:cmap.data_start]), index=index, starts=starts,
+                   fsdates=self._dates(fsdates),
+                   fhours=np.array([cmap.forecast[sdate] for sdate in fsdates], dtype=np.int32).reshape(-1, 2))
+      os.replace(tmpname, metaname)
+      self.evict()
+
+  def evict(self):
+      """removes least recently used entries until the total size of the cache is no more than max_bytes.
+         Temporary files older than tmp_age seconds are left over from a store which did not finish and
+         are removed. Newer ones may be a store in progress and are counted in the total size."""
+      entries = []
+      total = 0
+      now = time.time()
+      for fname in os.listdir(self.cdir):
+          fname = os.path.join(self.cdir, fname)
+          if fname.endswith('.tmp'):
+             try:
+                if now - os.path.getmtime(fname) > self.tmp_age:
+                   os.remove(fname)
+                else:
+                   total += os.path.getsize(fname)
+             except OSError:     #renamed or removed by another process.
+                pass
+             continue
+          if not fname.endswith('.npz'):
+             continue
+          metaname = fname
+          recname = metaname[:-4] + '.npy'
+          size = os.path.getsize(metaname)
+          if os.path.isfile(recname):
+             size += os.path.getsize(recname)
+          entries.append((os.path.getmtime(metaname), size, recname, metaname))
+          total += size
+      entries.sort()
+      for mtime, size, recname, metaname in entries:
+          if total <= self.max_bytes:
+             break
+          for fname in (recname, metaname):
+              if os.path.isfile(fname):
+                 os.remove(fname)
+          total -= size
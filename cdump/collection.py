@@ -0,0 +1,217 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import os
+import glob
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from cdump import ModelBin
+
+
+"""
+PYTHON 3
+ABSTRACT: reads a collection of HYSPLIT cdump files (e.g. one per source or per time split) in parallel.
+
+   The files are read in two passes by a pool of worker processes.
+   The first pass scans each file (ModelBin.scan) so the sampling periods, levels and pollutants of
+   the collection are known. The parent then allocates one multiprocessing.shared_memory block for the
+   whole collection, a float32 array (file, time, level, pollutant, nlat, nlon).
+   In the second pass each worker puts the concentrations of its file straight into its part of the
+   shared block, so no concentration arrays are pickled or copied back to the parent.
+
+   CLASSES
+   CdumpCollection - reads a list or directory of cdump files into one array.
+
+"""
+
+
+def _scan_file(args):
+    """scans a cdump file (ModelBin readwrite='s'). Used by CdumpCollection.load in worker processes.
+       args is (filename, drange, species, levels).
+       returns dictionary with filename, grid, pdates, levels, pollutants, pid and scan (seconds)."""
+    filename, drange, species, levels = args
+    start = time.perf_counter()
+    model = ModelBin(filename, cdir='', drange=drange, readwrite='s', species=species, levels=levels)
+    levels, pollutants = model._axes()
+    return {'filename': filename, 'grid': model._grid(), 'pdates': model.pdates,
+            'levels': [int(lev) for lev in levels], 'pollutants': pollutants,
+            'pid': os.getpid(), 'scan': time.perf_counter() - start}
+
+
+def _load_file(args):
+    """puts the concentrations of one cdump file into the shared memory block of a CdumpCollection.
+       Used by CdumpCollection.load in worker processes.
+       args is (name, shape, member, filename, drange, species, levels, sdates, all_levels, all_pollutants).
+       name and shape describe the shared memory block. member is the index of the file on the first axis.
+       sdates, all_levels and all_pollutants are the sample start times (numpy datetime64), levels and
+       pollutants of the other axes.
+       returns dictionary with filename, pid, read (seconds), nrec (number of records) and nbytes (bytes decoded)."""
+    name, shape, member, filename, drange, species, levels, sdates, all_levels, all_pollutants = args
+    start = time.perf_counter()
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        cube = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)[member]
+        cube[:] = 0
+        model = ModelBin(filename, cdir='', drange=drange, readwrite='s', species=species, levels=levels)
+        tindex = dict((sdate, t) for t, sdate in enumerate(sdates))
+        kindex = dict((lev, k) for k, lev in enumerate(all_levels))
+        pindex = dict((poll, p) for p, poll in enumerate(all_pollutants))
+        nrec = 0
+        nbytes = 0
+        index = model.cmap.index
+        for row in index[(index['ne'] >= 1) & model._select(index)]:
+            t = tindex.get(row['sdate'])
+            if t is None:
+               continue
+            poll, lev, cview = model.cmap.conc_view(row['offset'])
+            cube[t, kindex[lev], pindex[poll], cview['jndx'] - 1, cview['indx'] - 1] = cview['conc']
+            nrec += 1
+            nbytes += cview.nbytes
+    finally:
+        cube = None
+        shm.close()
+    return {'filename': filename, 'pid': os.getpid(), 'read': time.perf_counter() - start,
+            'nrec': nrec, 'nbytes': nbytes}
+
+
+class CdumpCollection(object):
+    """reads a collection of cdump files with the same concentration grid into one array.
+       methods:
+       load - reads the files in parallel into self.cube.
+       total - returns a ModelBin with the sum over the files.
+       model - returns a ModelBin for one of the files.
+       _model - returns a ModelBin with the header of one of the files.
+       close - releases the shared memory block.
+       attributes after load:
+       cube - float32 array (file, time, level, pollutant, nlat, nlon) in shared memory.
+       files, pdates, levels, pollutants - the axes of cube.
+       timings - list of dictionaries, one per file, with filename, scan and read (seconds),
+                 pid (worker process), nrec (records read) and nbytes (bytes of concentration records decoded).
+       Can be used as a context manager which calls close on exit.
+    """
+
+    def __init__(self, files, cdir='./', pattern='cdump*', drange=[], species=None, levels=None,
+                 processes=None, verbose=False):
+        """files - list of cdump file names or name of a directory. If a directory then the files in it
+                   which match pattern are read.
+           cdir - directory the file names in files are relative to (not used if files is a directory).
+           drange, species, levels - as for ModelBin. Used for all the files.
+           processes - number of worker processes. if None uses the number of cpus. if 1 the files are
+                       read in this process.
+        """
+        if isinstance(files, str):
+           files = sorted(glob.glob(os.path.join(files, pattern)))
+        else:
+           files = [cdir + fname for fname in files]
+        self.files = files
+        self.drange = drange
+        self.species = species
+        self.select_levels = levels
+        self.processes = processes
+        self.verbose = verbose
+        self.cube = None
+        self.shm = None
+        self.pdates = []
+        self.levels = []
+        self.pollutants = []
+        self.timings = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _map(self, func, args):
+        """returns list of func applied to args, in the order of args. Uses a pool of worker processes."""
+        if self.processes == 1 or len(args) <= 1:
+           return list(map(func, args))
+        with multiprocessing.Pool(self.processes) as pool:
+            return pool.map(func, args, chunksize=1)
+
+    def load(self):
+        """reads the files in parallel into self.cube (see module description).
+           returns False if there are no files or the concentration grids do not match else returns True."""
+        if not self.files:
+           print('Warning: CdumpCollection load - no files to read')
+           return False
+        self.close()
+        start = time.perf_counter()
+        args = [(fname, self.drange, self.species, self.select_levels) for fname in self.files]
+        scans = self._map(_scan_file, args)
+        grid = scans[0]['grid']
+        for scan in scans:
+            if scan['grid'] != grid:
+               print('warning: CdumpCollection load - concentration grid of ' + scan['filename'] + ' does not match')
+               return False
+        self.grid = grid
+        self.pdates = sorted(set(pdate for scan in scans for pdate in scan['pdates']))
+        self.levels = sorted(set(lev for scan in scans for lev in scan['levels']))
+        self.pollutants = []
+        for scan in scans:
+            for poll in scan['pollutants']:
+                if poll not in self.pollutants:
+                   self.pollutants.append(poll)
+        shape = (len(self.files), len(self.pdates), len(self.levels), len(self.pollutants), grid[0], grid[1])
+        nbytes = int(np.prod(shape)) * 4
+        self.shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        sdates = [np.datetime64(pdate[0], 'm') for pdate in self.pdates]
+        args = [(self.shm.name, shape, member, fname, self.drange, self.species, self.select_levels,
+                 sdates, self.levels, self.pollutants) for member, fname in enumerate(self.files)]
+        reads = self._map(_load_file, args)
+        self.cube = np.ndarray(shape, dtype=np.float32, buffer=self.shm.buf)
+        self.timings = []
+        for scan, read in zip(scans, reads):
+            self.timings.append({'filename': scan['filename'], 'pid': read['pid'], 'scan': scan['scan'],
+                                 'read': read['read'], 'nrec': read['nrec'], 'nbytes': read['nbytes']})
+            if self.verbose:
+               print('{0}: scan {1:.3f}s read {2:.3f}s {3} records {4} bytes (pid {5})'.format(
+                     scan['filename'], scan['scan'], read['read'], read['nrec'], read['nbytes'], read['pid']))
+        self.seconds = time.perf_counter() - start
+        if self.verbose:
+           print('read {0} files in {1:.3f}s'.format(len(self.files), self.seconds))
+        return True
+
+    def _model(self, member):
+        """returns a ModelBin (readwrite='s') for file number member for the axes of self.cube.
+           The levels and pollutants of the header are kept (so the level thicknesses do not change) and
+           those of the collection which are not in the file are added. The species and levels selections
+           are set to the axes of self.cube, so _axes returns them (in the order of the header)."""
+        model = ModelBin(self.files[member], cdir='', drange=self.drange, readwrite='s',
+                         species=self.species, levels=self.select_levels)
+        model.pdates = list(self.pdates)
+        model.levels = np.array(sorted(set(int(lev) for lev in model.levels) | set(self.levels)))
+        model.pollutants = list(model.pollutants) + [poll for poll in self.pollutants if poll not in model.pollutants]
+        model.select_levels = list(self.levels)
+        model.select_species = list(self.pollutants)
+        model.thicknesses()
+        return model
+
+    def _cube(self, model, cube):
+        """returns cube (time, level, pollutant, nlat, nlon) with the levels and pollutants of self.cube
+           put in the order returned by model._axes."""
+        levels, pollutants = model._axes()
+        cube = np.take(cube, [self.levels.index(lev) for lev in levels], axis=1)
+        return np.take(cube, [self.pollutants.index(poll) for poll in pollutants], axis=2)
+
+    def model(self, member=0):
+        """returns a ModelBin for file number member with a copy of self.cube[member] as its cube.
+           The header is read from the file."""
+        model = self._model(member)
+        model.cube = self._cube(model, self.cube[member])
+        model._cube_names()
+        return model
+
+    def total(self):
+        """returns a ModelBin with the sum of the concentrations over the files (see ModelBin._aggregate).
+           For files which are time splits of one run this joins them into one time series."""
+        model = self._model(0)
+        return model._aggregate(model.pdates, self._cube(model, self.cube.sum(axis=0)))
+
+    def close(self):
+        """releases the shared memory block. Arrays which are views of self.cube must be deleted first."""
+        self.cube = None
+        if self.shm is not None:
+           self.shm.close()
+           self.shm.unlink()
+           self.shm = None
@@ -0,0 +1,184 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import numpy as np
+from cdump import ModelBin
+
+
+"""
+PYTHON 3
+ABSTRACT: streaming statistics over an ensemble of HYSPLIT cdump files.
+
+   The members are read one sampling period at a time (ModelBin.iter_periods) and running
+   accumulators are updated member by member, so only one member's concentrations for one
+   sampling period are in memory at a time.
+
+   CLASSES
+   EnsembleStats - computes per grid cell mean, maximum, standard deviation, probability of
+                   exceeding thresholds and approximate percentiles for each sampling period.
+   P2Quantile - P-square online estimate of a quantile for every element of an array.
+
+"""
+
+
+class P2Quantile(object):
+    """P-square algorithm (Jain and Chlamtac, 1985) for an online estimate of a quantile.
+       Every element of the arrays passed to add is a separate estimate, so a quantile is
+       estimated for each grid cell with 5 heights and 5 positions per cell.
+       methods:
+       add - adds an array of observations.
+       value - returns the current estimate.
+    """
+
+    def __init__(self, prob):
+        """prob - quantile between 0 and 1 (0.9 for the 90th percentile)"""
+        self.prob = prob
+        self.nobs = 0
+        self.first = []      #first five observations
+        self.dn = np.array([0, prob / 2.0, prob, (1 + prob) / 2.0, 1])
+        self.desired = np.array([1, 1 + 2 * prob, 1 + 4 * prob, 3 + 2 * prob, 5])
+
+    def add(self, obs):
+        obs = np.asarray(obs, dtype=np.float64)
+        self.nobs += 1
+        if self.nobs <= 5:
+           self.first.append(obs.copy())
+           if self.nobs == 5:
+              self.heights = np.sort(np.stack(self.first), axis=0)
+              self.pos = np.tile(np.arange(1, 6, dtype=np.float64).reshape((5,) + (1,) * obs.ndim), (1,) + obs.shape)
+              self.first = []
+           return
+        qqq = self.heights
+        nnn = self.pos
+        #find cell k which contains the observation and adjust the extreme heights.
+        qqq[0] = np.minimum(qqq[0], obs)
+        qqq[4] = np.maximum(qqq[4], obs)
+        kkk = np.clip(np.sum(obs >= qqq[1:4], axis=0), 0, 3)
+        for iii in range(1, 5):
+            nnn[iii] += (kkk < iii)
+        self.desired = self.desired + self.dn
+        #adjust the heights of the middle markers
+        for iii in range(1, 4):
+            ddd = self.desired[iii] - nnn[iii]
+            move = ((ddd >= 1) & (nnn[iii + 1] - nnn[iii] > 1)) | ((ddd <= -1) & (nnn[iii - 1] - nnn[iii] < -1))
+            if not np.any(move):
+               continue
+            sss = np.sign(ddd) * move
+            #parabolic prediction
+            parab = qqq[iii] + sss / (nnn[iii + 1] - nnn[iii - 1]) * (
+                    (nnn[iii] - nnn[iii - 1] + sss) * (qqq[iii + 1] - qqq[iii]) / (nnn[iii + 1] - nnn[iii]) +
+                    (nnn[iii + 1] - nnn[iii] - sss) * (qqq[iii] - qqq[iii - 1]) / (nnn[iii] - nnn[iii - 1]))
+            #linear prediction where the parabolic one is not between the neighbouring heights
+            jjj = np.where(sss > 0, iii + 1, iii - 1)
+            qnext = np.where(sss > 0, qqq[iii + 1], qqq[iii - 1])
+            nnext = np.where(sss > 0, nnn[iii + 1], nnn[iii - 1])
+            linear = qqq[iii] + sss * (qnext - qqq[iii]) / (nnext - nnn[iii])
+            newq = np.where((qqq[iii - 1] < parab) & (parab < qqq[iii + 1]), parab, linear)
+            qqq[iii] = np.where(move, newq, qqq[iii])
+            nnn[iii] = nnn[iii] + sss
+
+    def value(self):
+        """returns the estimate of the quantile. Exact if fewer than 5 observations have been added."""
+        if self.nobs == 0:
+           return None
+        if self.nobs < 5:
+           return np.quantile(np.stack(self.first), self.prob, axis=0)
+        return self.heights[2].copy()
+
+
+class EnsembleStats(object):
+    """statistics over an ensemble of cdump files (members) which have the same concentration grid
+       and sampling periods.
+       methods:
+       iter_stats - generator which yields the statistics for each sampling period.
+       compute - returns list of the statistics for all sampling periods.
+    """
+
+    def __init__(self, members, cdir='./', drange=[], species=None, levels=None,
+                 thresholds=(), percentiles=(), verbose=False):
+        """members - list of cdump file names.
+           drange, species, levels - passed to ModelBin for each member.
+           thresholds - list of concentrations. The probability of exceeding (greater than) each is computed.
+                        This is the same test as cthresh in ModelBin.get_concentration.
+           percentiles - list of percentiles (0-100) which are estimated with P2Quantile.
+        """
+        self.members = members
+        self.cdir = cdir
+        self.drange = drange
+        self.species = species
+        self.levels = levels
+        self.thresholds = list(thresholds)
+        self.percentiles = list(percentiles)
+        self.verbose = verbose
+
+    def iter_stats(self):
+        """generator which yields a dictionary for each sampling period.
+           keys: sdate, edate - sample start and stop.
+                 levels, pollutants - axes of the arrays.
+                 nmembers - number of members.
+                 mean, max, std - arrays (level, pollutant, nlat, nlon).
+                 exceed - array (threshold, level, pollutant, nlat, nlon). probability of exceeding each threshold.
+                 percentiles - array (percentile, level, pollutant, nlat, nlon).
+           Prints a warning and stops if the members do not have the same grid, levels and pollutants,
+           the same sampling periods or the same number of sampling periods.
+        """
+        models = [ModelBin(member, cdir=self.cdir, drange=self.drange, readwrite='', species=self.species,
+                           levels=self.levels) for member in self.members]
+        for model in models:
+            model._open()
+        levels, pollutants = models[0]._axes()
+        for model in models[1:]:
+            if model._grid() != models[0]._grid() or model._axes() != (levels, pollutants):
+               print('warning: EnsembleStats - grid, levels or pollutants of members do not match',
+                     model.filename, models[0].filename)
+               return
+        iters = [model.iter_periods() for model in models]
+        while True:
+            periods = [next(piter, None) for piter in iters]
+            if all(period is None for period in periods):
+               return
+            if any(period is None for period in periods):
+               print('warning: EnsembleStats - members have different numbers of sampling periods',
+                     [model.filename for model, period in zip(models, periods) if period is None])
+               return
+            nnn = 0
+            for model, period in zip(models, periods):
+                if nnn == 0:
+                   sdate, edate = period.sdate, period.edate
+                elif period.sdate != sdate:
+                   print('warning: EnsembleStats - sampling periods of members do not match',
+                         model.filename, period.sdate, sdate)
+                   return
+                conc = period.cube()
+                nnn += 1
+                if nnn == 1:
+                   mean = np.zeros(conc.shape)
+                   msq = np.zeros(conc.shape)
+                   cmax = conc.copy()
+                   exceed = np.zeros((len(self.thresholds),) + conc.shape, dtype=np.int32)
+                   quantiles = [P2Quantile(pct / 100.0) for pct in self.percentiles]
+                else:
+                   np.maximum(cmax, conc, out=cmax)
+                #Welford's running mean and sum of squared differences
+                delta = conc - mean
+                mean += delta / nnn
+                msq += delta * (conc - mean)
+                for iii, thresh in enumerate(self.thresholds):
+                    exceed[iii] += (conc > thresh)
+                for quantile in quantiles:
+                    quantile.add(conc)
+            if self.verbose:
+               print('EnsembleStats', sdate, edate, nnn, 'members')
+            stats = {'sdate': sdate, 'edate': edate, 'levels': levels, 'pollutants': pollutants,
+                     'nmembers': nnn,
+                     'mean': mean.astype(np.float32),
+                     'max': cmax,
+                     'std': np.sqrt(msq / nnn).astype(np.float32),
+                     'exceed': (exceed / float(nnn)).astype(np.float32)}
+            if quantiles:
+               stats['percentiles'] = np.stack([quantile.value() for quantile in quantiles]).astype(np.float32)
+            else:
+               stats['percentiles'] = np.zeros((0,) + mean.shape, dtype=np.float32)
+            yield stats
+
+    def compute(self):
+        """returns list of the dictionaries yielded by iter_stats"""
+        return list(self.iter_stats())
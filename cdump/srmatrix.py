@@ -0,0 +1,289 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import os
+import multiprocessing
+import numpy as np
+from cdump import ModelBin
+
+
+"""
+PYTHON 3
+ABSTRACT: builds a source-receptor (transfer coefficient) matrix from HYSPLIT runs with unit releases.
+
+   Each cdump file is the result of one unit release (one location and release time) and is one column
+   of the matrix. Each row is a receptor: a grid cell for one sampling period, or an observation
+   (sample start, latitude, longitude).
+   The files are read in parallel worker processes and only the nonzero values are returned to the parent.
+   The matrix is kept in compressed sparse column form (data, indices, indptr) so columns can be
+   appended as new runs finish. If a directory is given the arrays are appended to files in it and
+   the matrix can be opened again later, with the arrays memory mapped.
+
+   CLASSES
+   SourceReceptorMatrix - builds the matrix and returns it as a scipy.sparse matrix.
+
+"""
+
+
+def _source_column(args):
+    """reads one cdump file and returns one column of the source receptor matrix.
+       Used by SourceReceptorMatrix.append in worker processes.
+       The file is scanned (ModelBin readwrite='s') and only the records of the sampling periods in sdates are
+       read. The receptor values are computed from the nonzero elements of the records (see ModelBin._records)
+       with the weights of get_concentration_cube, so no (time, nlat, nlon) array is made.
+       args is (filename, sdates, obs_t, obs_lat, obs_lon, species, levels, mass_loading, method).
+       returns (filename, grid, rows, values). rows and values are the nonzero elements of the column."""
+    filename, sdates, obs_t, obs_lat, obs_lon, species, levels, mass_loading, method = args
+    model = ModelBin(filename, cdir='', readwrite='s', species=species, levels=levels)
+    grid = model._grid()
+    nlat, nlon = grid[0], grid[1]
+    if not model.dataflag:
+       return filename, grid, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    weights, thickness = model._level_weights()
+    if mass_loading != 1:
+       weights = weights / np.float32(thickness)
+    axlevels, axpollutants = model._axes()
+    kindex = dict((lev, k) for k, lev in enumerate(axlevels))
+    pindex = dict((poll, p) for p, poll in enumerate(axpollutants))
+    filedates = set(pdate[0] for pdate in model.pdates)
+    if obs_t is not None:
+       jjj, iii, pweights, inside = model._point_index(obs_lat, obs_lon, method=method)
+       rcells = jjj * nlon + iii
+    rows = [np.zeros(0, dtype=np.int64)]
+    values = [np.zeros(0, dtype=np.float64)]
+    for t, sdate in enumerate(sdates):
+        if sdate not in filedates:     #sampling periods which are not in the file are 0.
+           continue
+        cells = []
+        cvals = []
+        for (poll, lev), (indx, jndx, conc) in model._records(sdate).items():
+            weight = weights[kindex[lev], pindex[poll]]
+            if weight != 0:
+               cells.append((np.asarray(jndx, dtype=np.int64) - 1) * nlon + np.asarray(indx, dtype=np.int64) - 1)
+               cvals.append(weight * np.asarray(conc, dtype=np.float32))
+        if not cells:
+           continue
+        #sum of the levels and pollutants for each grid cell with a nonzero concentration (sorted cell numbers).
+        cells, inverse = np.unique(np.concatenate(cells), return_inverse=True)
+        cvals = np.bincount(inverse, weights=np.concatenate(cvals), minlength=cells.size)
+        if obs_t is None:
+           rows.append(t * nlat * nlon + cells)
+           values.append(cvals)
+        else:
+           obs = np.flatnonzero(obs_t == t)
+           pos = np.minimum(np.searchsorted(cells, rcells[obs]), cells.size - 1)
+           rows.append(obs)
+           values.append((np.where(cells[pos] == rcells[obs], cvals[pos], 0) * pweights[obs]).sum(axis=1))
+    rows = np.concatenate(rows)
+    values = np.concatenate(values).astype(np.float32)
+    order = np.argsort(rows, kind='stable')
+    rows = rows[order]
+    values = values[order]
+    keep = values != 0
+    return filename, grid, rows[keep].astype(np.int64), values[keep]
+
+
+class SourceReceptorMatrix(object):
+    """builds a sparse source receptor matrix. Rows are receptors and columns are cdump files (unit sources).
+       methods:
+       append - reads cdump files in parallel and appends a column for each.
+       matrix - returns the matrix as a scipy.sparse matrix.
+       _save_receptors, _load - write and read the receptor description in the directory.
+       _truncate - removes the part of an append which was not completed from the files in the directory.
+       attributes:
+       sources - list of the cdump files of the columns.
+       shape - (number of receptors, number of sources).
+    """
+
+    def __init__(self, sdates=None, obs=None, species=None, levels=None, mass_loading=0, method='nearest',
+                 directory=None, processes=None, verbose=False):
+        """sdates - list of sample start dates. if obs is None the receptors are all the grid cells for each of
+                    these sampling periods. Row is (time * nlat + jndx - 1) * nlon + indx - 1.
+           obs - list of (sample start, latitude, longitude) observations. Each one is a receptor (row).
+                 The value is the concentration of the nearest grid cell or interpolated (see method).
+           species, levels - pollutants and levels summed for the receptor value (see ModelBin.get_concentration_cube).
+           mass_loading - if 1 the receptor value is mass loading otherwise concentration (see get_concentration_cube).
+           method - 'nearest' or 'bilinear' (see ModelBin.xtract_point). Used for obs.
+           directory - if not None the matrix is stored in this directory. If it already has a matrix
+                       it is opened and the other arguments are not used.
+           processes - number of worker processes. if None uses the number of cpus. if 1 the files are read
+                       in this process.
+        """
+        self.directory = directory
+        self.processes = processes
+        self.verbose = verbose
+        self.grid = None
+        self.sources = []
+        self.data = [np.zeros(0, dtype=np.float32)]
+        self.indices = [np.zeros(0, dtype=np.int64)]
+        self.indptr = [0]
+        if directory is not None and os.path.isfile(os.path.join(directory, 'receptors.npz')):
+           self._load()
+           return
+        if obs is None:
+           self.sdates = list(sdates)
+           self.obs_t = None
+           self.obs_lat = None
+           self.obs_lon = None
+        else:
+           self.sdates = sorted(set(ob[0] for ob in obs))
+           tindex = dict((sdate, t) for t, sdate in enumerate(self.sdates))
+           self.obs_t = np.array([tindex[ob[0]] for ob in obs], dtype=int)
+           self.obs_lat = np.array([ob[1] for ob in obs], dtype=float)
+           self.obs_lon = np.array([ob[2] for ob in obs], dtype=float)
+        self.species = species
+        self.levels = levels
+        self.mass_loading = mass_loading
+        self.method = method
+        if directory is not None:
+           if not os.path.isdir(directory):
+              os.makedirs(directory)
+           self._save_receptors()
+           np.zeros(1, dtype='<i8').tofile(os.path.join(directory, 'indptr.i8'))
+           for fname in ('indices.i8', 'data.f4', 'sources.txt'):
+               open(os.path.join(directory, fname), 'wb').close()
+
+    def _save_receptors(self):
+        """writes the receptor description to receptors.npz in self.directory."""
+        obs = self.obs_t is not None
+        np.savez(os.path.join(self.directory, 'receptors.npz'),
+                 sdates=np.array(self.sdates, dtype='M8[m]'),
+                 obs_t=self.obs_t if obs else np.zeros(0, dtype=int),
+                 obs_lat=self.obs_lat if obs else np.zeros(0),
+                 obs_lon=self.obs_lon if obs else np.zeros(0),
+                 obs=obs,
+                 grid=np.array(self.grid if self.grid is not None else [], dtype=float),
+                 species=np.array(self.species if self.species is not None else [], dtype='U4'),
+                 all_species=self.species is None,
+                 levels=np.array(self.levels if self.levels is not None else [], dtype=int),
+                 all_levels=self.levels is None,
+                 mass_loading=self.mass_loading, method=self.method)
+
+    def _load(self):
+        """reads the receptor description and the list of sources from self.directory.
+           The sparse arrays are memory mapped when matrix is called."""
+        receptors = np.load(os.path.join(self.directory, 'receptors.npz'))
+        self.sdates = list(receptors['sdates'].astype('M8[m]').astype(object))
+        if receptors['obs']:
+           self.obs_t = receptors['obs_t']
+           self.obs_lat = receptors['obs_lat']
+           self.obs_lon = receptors['obs_lon']
+        else:
+           self.obs_t = None
+           self.obs_lat = None
+           self.obs_lon = None
+        if receptors['grid'].size:
+           grid = receptors['grid']
+           self.grid = (int(grid[0]), int(grid[1])) + tuple(float(val) for val in grid[2:])
+        self.species = None if receptors['all_species'] else [str(sp) for sp in receptors['species']]
+        self.levels = None if receptors['all_levels'] else [int(lev) for lev in receptors['levels']]
+        self.mass_loading = int(receptors['mass_loading'])
+        self.method = str(receptors['method'])
+        indptr = np.fromfile(os.path.join(self.directory, 'indptr.i8'), dtype='<i8')
+        with open(os.path.join(self.directory, 'sources.txt')) as fid:
+            text = fid.read()
+        sources = text.splitlines()
+        if not text.endswith('\n'):
+           sources = sources[:-1]      #last line was not completely written.
+        self.sources = sources[:len(indptr) - 1]
+        self.indptr = [int(val) for val in indptr[:len(self.sources) + 1]]
+        self.data = None
+        self.indices = None
+        self._truncate()
+
+    def _truncate(self):
+        """truncates the files in self.directory to the columns in self.sources and self.indptr.
+           Removes what is left of an append which was not completed, so the next append writes its
+           columns straight after the last complete one."""
+        nnz = self.indptr[-1]
+        for fname, nbytes in (('data.f4', 4 * nnz), ('indices.i8', 8 * nnz), ('indptr.i8', 8 * len(self.indptr)),
+                              ('sources.txt', len(''.join(fname + '\n' for fname in self.sources).encode()))):
+            path = os.path.join(self.directory, fname)
+            if os.path.getsize(path) > nbytes:
+               os.truncate(path, nbytes)
+
+    @property
+    def shape(self):
+        if self.obs_t is not None:
+           nrow = len(self.obs_t)
+        elif self.grid is not None:
+           nrow = len(self.sdates) * self.grid[0] * self.grid[1]
+        else:
+           nrow = 0
+        return (nrow, len(self.sources))
+
+    def append(self, files, cdir=''):
+        """reads cdump files in parallel worker processes and appends a column for each.
+           Files which are already in self.sources are skipped.
+           Files whose concentration grid does not match the first file are skipped with a warning.
+           returns the number of columns appended."""
+        files = [cdir + fname for fname in files]
+        files = [fname for fname in files if fname not in self.sources]
+        args = [(fname, self.sdates, self.obs_t, self.obs_lat, self.obs_lon, self.species, self.levels,
+                 self.mass_loading, self.method) for fname in files]
+        if self.processes == 1 or len(args) <= 1:
+           pool = None
+           results = map(_source_column, args)
+        else:
+           pool = multiprocessing.Pool(self.processes)
+           results = pool.imap(_source_column, args, chunksize=1)
+        sources = []
+        data = []
+        indices = []
+        try:
+           for filename, grid, rows, values in results:
+               if self.grid is None:
+                  self.grid = grid
+                  if self.directory is not None:
+                     self._save_receptors()
+               if grid != self.grid:
+                  print('warning: SourceReceptorMatrix append - concentration grid of ' + filename + ' does not match')
+                  continue
+               sources.append(filename)
+               indices.append(rows)
+               data.append(values.astype(np.float32))
+               self.indptr.append(self.indptr[-1] + len(rows))
+               if self.verbose:
+                  print('appended', filename, len(rows), 'nonzero receptors')
+        finally:
+           if pool is not None:
+              pool.close()
+              pool.join()
+        if self.directory is not None:
+           #data and indices are written before indptr and sources so a partly written append is ignored
+           #and removed (see _truncate) when the matrix is opened again.
+           with open(os.path.join(self.directory, 'indices.i8'), 'ab') as fid:
+               for rows in indices:
+                   rows.astype('<i8').tofile(fid)
+           with open(os.path.join(self.directory, 'data.f4'), 'ab') as fid:
+               for values in data:
+                   values.astype('<f4').tofile(fid)
+           with open(os.path.join(self.directory, 'indptr.i8'), 'ab') as fid:
+               np.array(self.indptr[len(self.sources) + 1:], dtype='<i8').tofile(fid)
+           with open(os.path.join(self.directory, 'sources.txt'), 'a') as fid:
+               fid.write(''.join(fname + '\n' for fname in sources))
+        else:
+           self.data.extend(data)
+           self.indices.extend(indices)
+        self.sources.extend(sources)
+        return len(sources)
+
+    def _arrays(self):
+        """returns (data, indices, indptr) numpy arrays of the matrix in compressed sparse column form.
+           if self.directory is not None data and indices are memory mapped."""
+        indptr = np.array(self.indptr, dtype=np.int64)
+        nnz = int(indptr[-1])
+        if self.directory is None:
+           return np.concatenate(self.data), np.concatenate(self.indices), indptr
+        if nnz == 0:
+           return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64), indptr
+        data = np.memmap(os.path.join(self.directory, 'data.f4'), dtype='<f4', mode='r', shape=(nnz,))
+        indices = np.memmap(os.path.join(self.directory, 'indices.i8'), dtype='<i8', mode='r', shape=(nnz,))
+        return data, indices, indptr
+
+    def matrix(self, fmt='csr'):
+        """returns the matrix (receptor, source) as a scipy.sparse matrix.
+           fmt - 'csr', 'csc' or another scipy.sparse format. With 'csc' and a directory the matrix uses the
+                 memory mapped arrays without copying them."""
+        from scipy import sparse   #scipy is only needed for the matrix.
+        data, indices, indptr = self._arrays()
+        smatrix = sparse.csc_matrix((data, indices, indptr), shape=self.shape, copy=False)
+        return smatrix.asformat(fmt)
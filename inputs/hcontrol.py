@@ -612,7 +612,7 @@ class HycsControl():
             iii=0
             for sp in self.species:
                 if iii==0:
-                   fid.write(sp.strpollutant(annotate=True))
+                   fid.write(sp.strpollutant(annotate=annotate))
                 else: 
                    fid.write(sp.strpollutant(annotate=False))
                 iii+=1
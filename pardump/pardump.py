@@ -1,5 +1,6 @@
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 #from math import *
+import os
 import numpy as np
 import datetime
 import pandas as pd
@@ -24,10 +25,19 @@ FUNCTIONS
 class Pardump():
    """methods for writing and reading a pardump file.
       __init__  initializes structure of binary file.
-      write   writes a pardump file.
+      write   writes a pardump file with one time record.
+      write_records  writes many time records, with particles given in chunks (e.g. from a generator).
       read    reads a pardump file. returns a dictionary.
               Keys are the date of the particle positions in YYMMDDHH.
               Values are pandas dataframe objects with the particle information.
+      scan    memory maps the file and builds an index of the time records.
+      dates   returns the dates of the time records.
+      record  returns the particle data of one time record (view into the memory mapped file).
+      view    returns the particle data of one time record without the padding fields (no copy).
+      columns returns dictionary of arrays (lat, lon, ht, pmass, age, poll, sorti) for one time record.
+      iter_views  generator which yields the view of each time record.
+      frame   returns pandas dataframe for one time record.
+      tracks  returns (time, particle) arrays of lat, lon, ht and pmass aligned by the sort index.
    """
 
    def __init__(self, fname='PARINIT'):
@@ -37,6 +47,8 @@ class Pardump():
         """
         self.fname = fname
         self.dtfmt = "%Y%m%d%H%M"
+        self.index = None    #index of the time records. see scan.
+        self.mm = None       #memory map of the file. see scan.
 
         tp1='>f'    #big endian float.
         tp2='>i'    #big endian integer.
@@ -70,66 +82,336 @@ class Pardump():
                           ('mgrid',   tp2), 
                           ('sorti',   tp2)])
 
+        ##index of the time records built by scan.
+        self.index_dt = np.dtype([('date',    'M8[m]'),
+                                  ('parnum',  'i8'),
+                                  ('pollnum', 'i4'),
+                                  ('offset',  'i8')])
+
 
 
    def write(self, numpar, pmass, lon, lat , ht, pollnum, sdate):
         ##numpar - number of particles
         ## pmass, lon , lat , ht, pollnum , sdate  should all be lists or numpy arrays
         ##mass, longitude, latitude, height (in meters), pollutant index (integer), date (datetime.datetime object).
+        ##writes one time record with one pollutant (see write_records).
+        chunk = {}
+        for name, values in (('pmass', pmass), ('lon', lon), ('lat', lat), ('ht', ht), ('poll', pollnum)):
+            chunk[name] = np.broadcast_to(np.asarray(values), (numpar,))
+        self.write_records([(sdate, [chunk])], pollnum=1)
+
+   def write_records(self, records, pollnum=1, append=False, chunksize=100000):
+        """writes time records to the file.
+           records - iterable of (sdate, chunks). sdate is datetime object of the time record.
+                     chunks is an iterable of chunks of particles, e.g. a generator, so all the particles
+                     do not need to be in memory at once. A chunk is a dictionary of numpy arrays
+                     (or a numpy structured array such as returned by view) with fields
+                     lat, lon, ht and pmass, and optionally poll (default 1), age (0), dist (0),
+                     mgrid (1) and sorti (default numbers the particles of the time record from 1).
+                     pmass has shape (n,) or (n, pollnum).
+           pollnum - number of pollutants (length of the mass record of each particle).
+           append - if True the time records are added to the end of an existing file.
+           chunksize - number of particles copied into the output buffer at a time. Larger chunks are split.
+           The number of particles in the header of each time record is written once all its chunks are written.
+           returns list with the number of particles in each time record written."""
+        pardt = self._pardt(pollnum)
+        buf = np.zeros(chunksize, dtype=pardt)
+        buf['p1'] = 20                      #fortran record markers are the same for all particles
+        buf['p2'] = 4 * pollnum             #except p1 of the first particle (end of the header record).
+        buf['p3'] = (4 * pollnum << 32) + 24
+        buf['p4'] = (24 << 32) + 20
+        endrec = np.array([20], dtype='>i')
+        hdr = np.zeros((1,), dtype=self.hdr_dt)
+        hdr['padding'] = 28
+        hdr['pollnum'] = pollnum
+        if append and os.path.isfile(self.fname):
+           mode = 'r+b'
+        else:
+           mode = 'w+b'
+        parnums = []
+        with open(self.fname, mode) as fp:
+            fp.seek(0, os.SEEK_END)
+            for sdate, chunks in records:
+                if isinstance(chunks, (dict, np.ndarray)):
+                   chunks = [chunks]
+                hdr['year'] =   sdate.year
+                hdr['month'] =  sdate.month
+                hdr['day'] =    sdate.day
+                hdr['hour'] =   sdate.hour
+                hdr['minute'] = sdate.minute
+                hdr['parnum'] = 0
+                hpos = fp.tell()
+                fp.write(hdr)                #placeholder. parnum is written after the particles.
+                parnum = 0
+                for chunk in chunks:
+                    nchunk = len(chunk['lat'])
+                    for first in range(0, nchunk, chunksize):
+                        last = min(first + chunksize, nchunk)
+                        a = buf[:last - first]
+                        for name in ('lat', 'lon', 'ht', 'pmass', 'poll', 'age', 'dist', 'mgrid', 'sorti'):
+                            if self._has_field(chunk, name):
+                               values = np.asarray(chunk[name][first:last])
+                               if name == 'pmass' and pollnum > 1 and values.ndim == 1:
+                                  values = values[:, np.newaxis]
+                               a[name] = values
+                            elif name == 'sorti':
+                               a[name] = np.arange(parnum + 1, parnum + 1 + a.size)
+                            else:
+                               a[name] = {'poll': 1, 'mgrid': 1}.get(name, 0)
+                        if parnum == 0:
+                           a['p1'][0] = 28
+                        fp.write(a)
+                        a['p1'][0] = 20
+                        parnum += a.size
+                fp.write(endrec)
+                end = fp.tell()
+                hdr['parnum'] = parnum
+                fp.seek(hpos)
+                fp.write(hdr)
+                fp.seek(end)
+                parnums.append(parnum)
+        self.index = None
+        return parnums
+
+   def _has_field(self, chunk, name):
+        """returns True if the chunk (dictionary or numpy structured array) has the field name."""
+        if isinstance(chunk, np.ndarray):
+           return name in (chunk.dtype.names or ())
+        return name in chunk
 
-        with open(self.fname, 'wb') as fp:
-            pad1 = np.ones(numpar) * 28
-            pad2 = np.ones(numpar) * 4
-            pad3 = np.ones(numpar) * 17179869208
-            pad4 = np.ones(numpar) * 103079215124.0
-            zrs = np.zeros(numpar)
-            ones = np.ones(numpar)
-            sorti = np.arange(1,numpar+1)
-
-            print(len(lon))      
-            a = np.zeros((numpar,), dtype=self.pardt)
-            a['p1'] = pad1
-            a['p2'] = pad2
-            a['p3'] = pad3
-            a['p4'] = pad4
-
-            a['lat'] = lat
-            a['lon'] = lon
-            a['ht']  = ht
-            a['pmass'] = pmass
-            a['poll']  = pollnum
-
-            a['age'] =  zrs
-            a['dist'] = zrs
-
-            a['mgrid'] = ones
-            a['sorti'] = sorti
-
-            #print a
-
-            hdr = np.zeros((1,), dtype=self.hdr_dt)
-            hdr['padding'] = 28
-            hdr['parnum'] = numpar
-            hdr['pollnum'] = 1
-            hdr['year'] =   sdate.year
-            hdr['month'] =  sdate.month
-            hdr['day'] =    sdate.day
-            hdr['hour'] =   sdate.hour
-            hdr['minute'] = sdate.minute
-            print(hdr)
-
-            endrec = np.array([20], dtype='>i')
-
-            fp.write(hdr)
-            fp.write(a)
-            fp.write(endrec)
-            fp.write(endrec)
-
-       
    #def writeascii(self, drange=[], verbose=1, century=2000, sorti=[]):
    #    read(self, drange=[], verbose=1, century=2000, sorti=[]):
         
  
+   def _pardt(self, pollnum=1):
+        """returns the dtype of the particle records for a time record with pollnum pollutants.
+           The mass record (pmass) has one value for each pollutant so pmass has shape (pollnum,)
+           if there is more than one pollutant. The fortran record markers p2 and p3 depend on pollnum."""
+        if pollnum == 1:
+           return self.pardt
+        descr = []
+        for name in self.pardt.names:
+            if name == 'pmass':
+               descr.append((name, self.pardt[name].str, (pollnum,)))
+            else:
+               descr.append((name, self.pardt[name].str))
+        return np.dtype(descr)
+
+   def scan(self, century=2000):
+        """memory maps the file and reads only the header (hdr_dt) of each time record.
+           parnum and pollnum in the header give the length of the record so the particle data is skipped.
+           Builds self.index, a numpy structured array (dtype index_dt) with one row for each time record.
+           fields are date, parnum, pollnum and offset (byte offset of the header).
+           There is no limit on the number of time records. Scanning stops at a time record which is
+           not complete (file still being written) or which does not begin with a header.
+           returns self.index"""
+        rows = []
+        if os.path.getsize(self.fname) > 0:
+           self.mm = np.memmap(self.fname, dtype=np.uint8, mode='r')
+           nbytes = self.mm.shape[0]
+        else:
+           self.mm = np.zeros(0, dtype=np.uint8)
+           nbytes = 0
+        offset = 0
+        while offset + self.hdr_dt.itemsize <= nbytes:
+            hdata = np.frombuffer(self.mm, dtype=self.hdr_dt, count=1, offset=offset)[0]
+            parnum = int(hdata['parnum'])
+            pollnum = int(hdata['pollnum'])
+            if hdata['padding'] != 28 or parnum < 0 or pollnum < 1:
+               break
+            end = offset + self.hdr_dt.itemsize + parnum * self._pardt(pollnum).itemsize + 4
+            if end > nbytes:
+               break
+            year = int(hdata['year'])
+            if year < 1000:
+               year += century
+            pdate = datetime.datetime(year, int(hdata['month']), int(hdata['day']), int(hdata['hour']),
+                                      int(hdata['minute']))
+            rows.append((pdate, parnum, pollnum, offset))
+            offset = end
+        self.index = np.array(rows, dtype=self.index_dt)
+        return self.index
+
+   def dates(self):
+        """returns list of the dates (datetime objects) of the time records. Scans the file if needed."""
+        if self.index is None:
+           self.scan()
+        return list(self.index['date'].astype(datetime.datetime))
+
+   def _find(self, pdate):
+        """returns the number of the time record (row of self.index) for pdate.
+           pdate can be a datetime object, a key as used by read (YYYYMMDDHHMM) or a record number."""
+        if self.index is None:
+           self.scan()
+        if isinstance(pdate, (int, np.integer)):
+           return int(pdate)
+        if isinstance(pdate, str):
+           pdate = datetime.datetime.strptime(pdate, self.dtfmt)
+        iii = np.flatnonzero(self.index['date'] == np.datetime64(pdate, 'm'))
+        if iii.size == 0:
+           raise KeyError('Pardump: no time record for ' + str(pdate) + ' in ' + self.fname)
+        return int(iii[0])
+
+   def record(self, pdate):
+        """returns the particle data for one time record as a read only numpy structured array (dtype pardt,
+           big endian) which is a view into the memory mapped file (no copy).
+           pdate - datetime object, key as used by read (YYYYMMDDHHMM) or number of the time record.
+           Random access - only this time record is looked at."""
+        iii = self._find(pdate)           #scans the file if needed so find before using self.index.
+        row = self.index[iii]
+        return np.frombuffer(self.mm, dtype=self._pardt(int(row['pollnum'])), count=int(row['parnum']),
+                             offset=int(row['offset']) + self.hdr_dt.itemsize)
+
+   def _view_dt(self, pollnum=1, fields=None):
+        """returns dtype with only the fields given (default is all fields except the fortran record
+           markers p1-p4) at their offsets in the particle records. Used to view the records without the padding."""
+        pardt = self._pardt(pollnum)
+        if fields is None:
+           fields = [name for name in pardt.names if name not in ('p1', 'p2', 'p3', 'p4')]
+        return np.dtype({'names': list(fields),
+                         'formats': [pardt.fields[name][0] for name in fields],
+                         'offsets': [pardt.fields[name][1] for name in fields],
+                         'itemsize': pardt.itemsize})
+
+   def view(self, pdate, fields=None):
+        """returns the particle data for one time record as a read only, big endian numpy structured array
+           without the padding fields. It is a strided view into the memory mapped file (no copy).
+           pdate - datetime object, key as used by read (YYYYMMDDHHMM) or number of the time record.
+           fields - list of field names. default is all fields except the padding."""
+        iii = self._find(pdate)
+        data = self.record(iii)
+        pollnum = int(self.index['pollnum'][iii])
+        return data.view(self._view_dt(pollnum, fields))
+
+   def columns(self, pdate, fields=('lat', 'lon', 'ht', 'pmass', 'age', 'poll', 'sorti'), native=True,
+               released=False):
+        """returns dictionary of 1d numpy arrays (2d for pmass with more than one pollutant), one for each field,
+           for one time record.
+           native - if True the arrays are native byte order copies of each field asked for.
+                    if False the arrays are big endian strided views into the memory mapped file (no copy).
+                    numpy does arithmetic on big endian arrays, converting as needed.
+           released - if True only particles which have been released (lat != 0) are returned."""
+        data = self.view(pdate, fields=list(fields) + (['lat'] if released and 'lat' not in fields else []))
+        if released:
+           keep = data['lat'] != 0
+        columns = {}
+        for name in fields:
+            column = data[name]
+            if native:
+               column = column.astype(column.dtype.newbyteorder('='))
+            if released:
+               column = column[keep]
+            columns[name] = column
+        return columns
+
+   def iter_views(self, drange=[], fields=None):
+        """generator which yields (date, view) for each time record within drange (see view)."""
+        if self.index is None:
+           self.scan()
+        for iii, pdate in enumerate(self.index['date'].astype(datetime.datetime)):
+            if drange != [] and pdate > drange[1]:
+               break
+            if drange == [] or pdate >= drange[0]:
+               yield pdate, self.view(iii, fields=fields)
+
+   def frame(self, pdate, sorti=[]):
+        """returns pandas dataframe for one time record in the form returned by read (opt in conversion)."""
+        iii = self._find(pdate)
+        return self._frame(self.record(iii), self.index['date'][iii].astype(datetime.datetime), self._lookup(sorti))
+
+   def _lookup(self, sorti):
+        """returns lookup array for the sort indices in sorti. lookup[s] is the position of sort index s in sorti
+           or -1 if s is not in sorti. returns None if sorti is empty.
+           Finding the particles of a time record is then one indexing operation instead of a join."""
+        sorti = np.asarray(sorti, dtype=np.int64)
+        if sorti.size == 0:
+           return None
+        lookup = np.full(int(sorti.max()) + 1, -1, dtype=np.int64)
+        lookup[sorti] = np.arange(sorti.size)
+        return lookup
+
+   def _position(self, lookup, sorti):
+        """returns position (see _lookup) of each particle with sort index in array sorti. -1 if not in lookup."""
+        sorti = np.asarray(sorti, dtype=np.int64)
+        inside = (sorti >= 0) & (sorti < lookup.size)
+        position = np.full(sorti.shape, -1, dtype=np.int64)
+        position[inside] = lookup[sorti[inside]]
+        return position
+
+   def tracks(self, drange=[], sorti=[], fields=('lat', 'lon', 'ht', 'pmass')):
+        """returns the particle tracks. The time records within drange are aligned by the sort index of the
+           particles into dense (time, particle) float32 arrays.
+           sorti - list of sort indices of the particles to return. if [] then all particles which are released
+                   in any of the time records.
+           fields - fields to return. pmass has shape (time, particle, pollnum) if there is more than one pollutant.
+           The values are NaN for times when a particle has not been released yet (lat is 0) or is not in the
+           time record (removed).
+           returns dictionary with the arrays for each field, 'date' (numpy datetime64 array of the times, axis 0)
+           and 'sorti' (sort index of the particles, axis 1)."""
+        if self.index is None:
+           self.scan()
+        dates = self.index['date'].astype(datetime.datetime)
+        records = [iii for iii, pdate in enumerate(dates)
+                   if drange == [] or drange[0] <= pdate <= drange[1]]
+        if len(sorti) == 0:
+           #union of the sort indices of the released particles.
+           smax = 0
+           for iii in records:
+               data = self.view(iii, fields=['lat', 'sorti'])
+               if data.size:
+                  smax = max(smax, int(data['sorti'].max()))
+           released = np.zeros(smax + 1, dtype=bool)
+           for iii in records:
+               data = self.view(iii, fields=['lat', 'sorti'])
+               released[data['sorti'][data['lat'] != 0]] = True
+           sorti = np.flatnonzero(released)
+        sorti = np.asarray(sorti, dtype=np.int64)
+        lookup = self._lookup(sorti)
+        shape = (len(records), sorti.size)
+        pollnum = int(self.index['pollnum'][records].max()) if records else 1
+        tracks = {'date': self.index['date'][records], 'sorti': sorti}
+        for name in fields:
+            if name == 'pmass' and pollnum > 1:
+               tracks[name] = np.full(shape + (pollnum,), np.nan, dtype=np.float32)
+            else:
+               tracks[name] = np.full(shape, np.nan, dtype=np.float32)
+        if lookup is None:
+           return tracks
+        for ttt, iii in enumerate(records):
+            data = self.view(iii, fields=sorted(set(fields) | set(['lat', 'sorti'])))
+            position = self._position(lookup, data['sorti'])
+            keep = (position >= 0) & (data['lat'] != 0)
+            position = position[keep]
+            for name in fields:
+                values = data[name][keep]
+                if name == 'pmass' and pollnum > 1:
+                   values = values.reshape(values.shape[0], -1)
+                   tracks[name][ttt, position, :values.shape[1]] = values
+                else:
+                   tracks[name][ttt, position] = values
+        return tracks
+
+   def _frame(self, data, pdate, lookup=None):
+        """returns pandas dataframe from the particle data of one time record in the form returned by read."""
+        ndata = data.astype(data.dtype.newbyteorder('='))     #otherwise get endian error message when create dataframe.
+        columns = {}
+        for name in ('pmass', 'lat', 'lon', 'ht', 'age', 'dist', 'poll', 'sorti'):
+            if name == 'pmass' and ndata[name].ndim == 2:
+               for ppp in range(ndata[name].shape[1]):
+                   columns['pmass' + str(ppp + 1)] = ndata[name][:, ppp]
+            else:
+               columns[name] = ndata[name]
+        par_frame = pd.DataFrame(columns)
+        par_frame = par_frame.loc[par_frame['lat'] != 0]              #drop where the lat field is 0. because
+                                                                      #in pardump file particles which have not been
+                                                                      #released yet
+        if lookup is not None:
+           par_frame = par_frame.loc[self._position(lookup, par_frame['sorti'].values) >= 0]
+                                                                      #returns only particles with
+                                                                      #sort index in list sorti (see _lookup)
+        par_frame['date'] = pdate
+        par_frame = par_frame.sort_values('ht')                       #sort by height
+        return pd.concat([par_frame], keys=[self.fname])              #add a filename key
 
    def read(self, drange=[], verbose=1, century=2000, sorti=[]):
         """ daterange should be a list of two datetime.datetime objects indicating the beginning
@@ -138,78 +420,32 @@ class Pardump():
         ##The value is a pandas dataframe object with the particle information.
         ##sorti is a list of sort indices. If not [] then will only return particles with those sort indices. 
         ##nsort keeps track of which particle it is throughout the time.
-        ##Could use this to keep track of initial height and time of release. 
+        ##Could use this to keep track of initial height and time of release (see tracks).
+        ##The file is memory mapped and scanned first (see scan) so only the time records within drange
+        ##are decoded. There is no limit on the number of time records.
+        ##If there is more than one pollutant the mass columns are pmass1, pmass2, ...
 
 
         """
 
-        imax = 100
-        #fp = open(self.fname, 'rb')
         pframe_hash = {}     #returns a dictionary of pandas dataframes. Date valid is the key.
-        with  open(self.fname, 'rb') as fp:
-            i=0
-            testf = True
-            while testf:
-                hdata = np.fromfile(fp, dtype=self.hdr_dt, count=1)
-                if verbose:
-                   print('Record Header ' , hdata)  
-                if len(hdata) == 0:
-                   print('Done reading ' , self.fname)
-                   break
-                if hdata['year'] < 1000:
-                   year = hdata['year'] + century
-                else:
-                   year = hdata['year']
-                pdate = datetime.datetime(year, hdata['month'], hdata['day'], hdata['hour'], hdata['minute'])
-                #if drange==[]:
-                #   drange = [pdate, pdate]
-                parnum = hdata['parnum']
-                data = np.fromfile(fp, dtype= self.pardt, count=parnum)
-                n= parnum-1
-                np.fromfile(fp, dtype='>i', count=1)  #padding at end of each record
-                if verbose:
-                   print('Date ' ,  pdate , ' **** ' , drange)
-            
-                testdate = False 
-                if drange ==[]:
-                   testdate = True
-                elif pdate >= drange[0] and pdate <=drange[1]:          
-                   testdate = True
-                 
-                if testdate:                                              #Only store data if it is in the daterange specified.
-                   print('Adding data ' , hdata   , pdate)
-                   ndata = data.byteswap().newbyteorder()                 #otherwise get endian error message when create dataframe.
-                   par_frame = pd.DataFrame.from_records(ndata)           #create data frame
-                   par_frame.drop(['p1','p2','p3','p4'], inplace=True, axis=1)   #drop the fields which were padding
-                   par_frame.drop(['su','sv','sx','mgrid'], inplace=True, axis=1)        #drop other fields
-                   par_frame = par_frame.loc[par_frame['lat'] != 0]              #drop where the lat field is 0. because
-                                                                                 #in pardump file particles which have not been
-                                                                                 #released yet 
-                   
-                   if sorti != []:
-                      par_frame = par_frame.loc[par_frame['sorti'].isin(sorti)]          #returns only particles with 
-                                                                                          #sort index in list sorti
-                   par_frame['date'] = pdate
-                   par_frame.sort('ht', inplace=True)                                    #sort by height
-                   par_frame = pd.concat([par_frame], keys=[self.fname])                 #add a filename key
-                   datekey = pdate.strftime(self.dtfmt)                                  #create dictionary key for output.
-                   pframe_hash[datekey] = par_frame                                      #Add value to dictionary.
-
-                ##Assume data is written sequentially by date.
-                i+= 1
-
-                if drange !=[]:
-                    if pdate > drange[1]:                         
-                       testf=False
-                       if verbose:
-                          print("Past date. Closing file." , drange[1] , pdate)
-                    #elif  drange[0] < pdate:                                           
-                    #   testf=False
-                    #   if verbose:
-                    #      print "Before date. Closing file"
-                if i > imax:
-                   print('Read pardump. Limited to 100 iterations. Stopping')
-                   testf=False
+        self.scan(century=century)
+        lookup = self._lookup(sorti)
+        for iii, row in enumerate(self.index):
+            pdate = row['date'].astype(datetime.datetime)
+            if verbose:
+               print('Date ' ,  pdate , ' **** ' , drange)
+            if drange != [] and pdate > drange[1]:                 ##Assume data is written sequentially by date.
+               if verbose:
+                  print("Past date. Closing file." , drange[1] , pdate)
+               break
+            if drange == [] or pdate >= drange[0]:                 #Only store data if it is in the daterange specified.
+               if verbose:
+                  print('Adding data ' , row['parnum'], pdate)
+               datekey = pdate.strftime(self.dtfmt)                                  #create dictionary key for output.
+               pframe_hash[datekey] = self._frame(self.record(iii), pdate, lookup)   #Add value to dictionary.
+        if verbose:
+           print('Done reading ' , self.fname)
         return pframe_hash
 
 
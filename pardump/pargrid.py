@@ -0,0 +1,222 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import os
+import sys
+import datetime
+import multiprocessing
+import numpy as np
+from pardump import Pardump
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cdump'))
+
+
+"""
+PYTHON 3
+ABSTRACT: computes concentrations on a lat-lon-level grid from the particle positions in a HYSPLIT pardump file.
+
+   The mass of each particle is added to the grid cell it is in with np.bincount, so the concentrations
+   can be recomputed on a new grid from a saved pardump file instead of running HYSPLIT again with a
+   different concentration grid in the CONTROL file.
+   Each time record of the pardump file is a snapshot of the particles and gives one sampling period.
+   Time records are binned in parallel worker processes. The workers memory map the pardump file
+   (see Pardump.scan) so only the concentration arrays are returned to the parent.
+   The result can be written as a cdump file with ModelBin (cdump/cdump.py).
+
+   Only particles (three dimensional) are binned. Puffs and deposition are not in the pardump file so
+   a level with top height 0 (deposition) is always 0.
+
+   CLASSES
+   ParGrid - bins pardump particles onto a concentration grid.
+
+"""
+
+
+def _grid_from_concgrid(cgrid):
+    """returns tuple (nlat, nlon, dlat, dlon, llcrnr_lat, llcrnr_lon) (see ModelBin._grid) for a ConcGrid object.
+       The grid points are centered on (centerlat, centerlon) and span latspan, lonspan degrees."""
+    if cgrid.latdiff <= 0 or cgrid.londiff <= 0:
+       raise ValueError('ParGrid: ConcGrid ' + str(cgrid.name) + ' needs latdiff and londiff greater than 0')
+    nlat = int(round(float(cgrid.latspan) / cgrid.latdiff)) + 1
+    nlon = int(round(float(cgrid.lonspan) / cgrid.londiff)) + 1
+    return (nlat, nlon, float(cgrid.latdiff), float(cgrid.londiff),
+            float(cgrid.centerlat) - (nlat - 1) * cgrid.latdiff / 2.0,
+            float(cgrid.centerlon) - (nlon - 1) * cgrid.londiff / 2.0)
+
+
+def _bin(lat, lon, ht, pmass, poll, grid, levels, npoll, smooth=0, concentration=True):
+    """returns float32 array (level, pollutant, nlat, nlon) of the particles binned onto the grid.
+       lat, lon, ht - particle positions. particles with lat = 0 have not been released and are not used.
+       pmass - particle mass. shape (n,) or (n, number of pollutants).
+       poll - pollutant index (starts at 1) of each particle. Only used if pmass has shape (n,).
+       grid - (nlat, nlon, dlat, dlon, llcrnr_lat, llcrnr_lon). Grid points are the centers of the cells.
+       levels - top heights of the levels (m). A particle is in level k if levels[k-1] < ht <= levels[k].
+       smooth - standard deviation, in grid cells, of a gaussian kernel used to smooth each field. 0 for none.
+       concentration - if True returns mass / volume of the cell. Otherwise returns mass in each cell."""
+    from cdump import _lon_index, _global_lon, _cell_area
+    nlat, nlon, dlat, dlon, llcrnr_lat, llcrnr_lon = grid
+    levels = np.asarray(levels, dtype=np.float64)
+    kout = np.flatnonzero(levels > 0)        #level 0 is deposition.
+    tops = levels[kout]
+    nlev = levels.size
+    lat = np.asarray(lat, dtype=np.float64)
+    jjj = np.floor((lat - llcrnr_lat) / dlat + 0.5).astype(np.int64)
+    #the grid may cross 180. on a global grid the last column is next to the first one.
+    iii = np.floor(_lon_index(lon, llcrnr_lon, dlon) + 0.5).astype(np.int64)
+    if _global_lon(nlon, dlon):
+       iii = iii % nlon
+    kkk = np.searchsorted(tops, np.asarray(ht, dtype=np.float64), side='left')
+    keep = (lat != 0) & (jjj >= 0) & (jjj < nlat) & (iii >= 0) & (iii < nlon) & (kkk < tops.size)
+    pmass = np.asarray(pmass, dtype=np.float64)
+    if pmass.ndim == 1:
+       ppp = np.asarray(poll, dtype=np.int64) - 1 if poll is not None else np.zeros(lat.size, dtype=np.int64)
+       keep &= (ppp >= 0) & (ppp < npoll)
+       columns = [(ppp[keep], pmass[keep])]
+    else:
+       columns = [(np.full(int(keep.sum()), ppp, dtype=np.int64), pmass[keep, ppp])
+                  for ppp in range(min(npoll, pmass.shape[1]))]
+    cell = (kout[kkk[keep]] * npoll * nlat + jjj[keep]) * nlon + iii[keep]
+    size = nlev * npoll * nlat * nlon
+    total = np.zeros(size, dtype=np.float64)
+    for ppp, mass in columns:
+        total += np.bincount(cell + ppp * nlat * nlon, weights=mass, minlength=size)
+    total = total.reshape(nlev, npoll, nlat, nlon)
+    if smooth > 0:
+       from scipy import ndimage   #scipy is only needed for smoothing.
+       total = ndimage.gaussian_filter(total, sigma=(0, 0, smooth, smooth), mode='constant')
+    if concentration:
+       thickness = np.diff(np.concatenate([[0], levels]))
+       thickness[thickness <= 0] = np.inf
+       volume = thickness[:, np.newaxis, np.newaxis] * _cell_area(nlat, dlat, llcrnr_lat, dlon)[:, np.newaxis]
+       total = total / volume[:, np.newaxis]
+    return total.astype(np.float32)
+
+
+def _bin_record(args):
+    """bins one time record of a pardump file. Used by ParGrid.read in worker processes.
+       args is (filename, record, grid, levels, npoll, smooth, concentration).
+       returns float32 array (level, pollutant, nlat, nlon) (see _bin)."""
+    filename, record, grid, levels, npoll, smooth, concentration = args
+    pdump = Pardump(filename)
+    pdump.scan()
+    data = pdump.view(record, fields=['lat', 'lon', 'ht', 'pmass', 'poll'])
+    return _bin(data['lat'], data['lon'], data['ht'], data['pmass'], data['poll'], grid, levels, npoll,
+                smooth=smooth, concentration=concentration)
+
+
+class ParGrid(object):
+    """bins the particles of a pardump file onto a concentration grid.
+       methods:
+       bin - returns concentrations (level, pollutant, nlat, nlon) from arrays of particle positions and mass.
+       read - bins the time records of a pardump file into self.cube.
+       model - returns a ModelBin with self.cube which can be written as a cdump file.
+       write - writes a cdump file.
+       attributes:
+       grid - (nlat, nlon, dlat, dlon, llcrnr_lat, llcrnr_lon) (see ModelBin._grid).
+       levels - top heights of the levels (m).
+       species - pollutant identifiers.
+       after read:
+       pdates - list of (sample start, sample stop) for each time record read.
+       cube - float32 array (time, level, pollutant, nlat, nlon).
+    """
+
+    def __init__(self, grid, levels=None, species=None, smooth=0, concentration=True, processes=None,
+                 verbose=False):
+        """grid - ConcGrid object (inputs/hcontrol.py), ModelBin or tuple (nlat, nlon, dlat, dlon, llcrnr_lat, llcrnr_lon).
+           levels - list of level top heights (m). Default is the levels of the ConcGrid or ModelBin.
+           species - list of pollutant identifiers (4 characters). The pollutant index of the particles (poll) or
+                     the column of pmass is the position in this list (starting at 1).
+                     if None then P001, P002, ... for the number of pollutants in the pardump file.
+           smooth - standard deviation in grid cells of a gaussian kernel which smooths each field. 0 for no smoothing.
+           concentration - if True the values are mass / volume of the grid cell (as in a cdump file).
+                           Otherwise mass in each grid cell.
+           processes - number of worker processes used by read. if None uses the number of cpus. if 1 the time
+                       records are binned in this process.
+        """
+        if isinstance(grid, tuple):
+           self.grid = (int(grid[0]), int(grid[1])) + tuple(float(val) for val in grid[2:])
+        elif hasattr(grid, '_grid'):
+           self.grid = grid._grid()
+           if levels is None:
+              levels = [int(lev) for lev in grid.levels]
+        else:
+           self.grid = _grid_from_concgrid(grid)
+           if levels is None:
+              levels = grid.levels
+        if not levels:
+           raise ValueError('ParGrid: no levels given')
+        self.levels = [int(lev) for lev in levels]
+        self.species = species
+        self.smooth = smooth
+        self.concentration = concentration
+        self.processes = processes
+        self.verbose = verbose
+        self.pdates = []
+        self.cube = None
+        self.sourcedate = []
+
+    def _npoll(self, npoll=1):
+        """returns the number of pollutants. Sets self.species if it is None."""
+        if self.species is None:
+           self.species = ['P%03d' % (ppp + 1) for ppp in range(npoll)]
+        return len(self.species)
+
+    def bin(self, lat, lon, ht, pmass, poll=None):
+        """returns float32 array (level, pollutant, nlat, nlon) from arrays of particle positions and mass (see _bin).
+           pmass has shape (n,) with poll the pollutant index of each particle or shape (n, number of pollutants)."""
+        npoll = np.shape(pmass)[1] if np.ndim(pmass) == 2 else (int(np.max(poll)) if poll is not None and np.size(poll) else 1)
+        return _bin(lat, lon, ht, pmass, poll, self.grid, self.levels, self._npoll(npoll),
+                    smooth=self.smooth, concentration=self.concentration)
+
+    def read(self, pdump, drange=[], duration=datetime.timedelta(0)):
+        """bins the time records of a pardump file within drange into self.cube.
+           pdump - Pardump object or file name.
+           duration - length of the sampling period given to each time record. The sampling period is
+                      (time of the record, time of the record + duration).
+           returns self.cube (time, level, pollutant, nlat, nlon)."""
+        if not isinstance(pdump, Pardump):
+           pdump = Pardump(pdump)
+        pdump.scan()
+        dates = pdump.dates()
+        records = [iii for iii, pdate in enumerate(dates) if drange == [] or drange[0] <= pdate <= drange[1]]
+        npoll = 1
+        for iii in records:
+            data = pdump.view(iii, fields=['poll'])
+            npoll = max(npoll, int(pdump.index['pollnum'][iii]), int(data['poll'].max()) if data.size else 1)
+        npoll = self._npoll(npoll)
+        args = [(pdump.fname, iii, self.grid, self.levels, npoll, self.smooth, self.concentration) for iii in records]
+        if self.processes == 1 or len(args) <= 1:
+           fields = list(map(_bin_record, args))
+        else:
+           with multiprocessing.Pool(self.processes) as pool:
+               fields = pool.map(_bin_record, args, chunksize=1)
+        self.pdates = [(dates[iii], dates[iii] + duration) for iii in records]
+        self.cube = np.zeros((len(records), len(self.levels), npoll, self.grid[0], self.grid[1]), dtype=np.float32)
+        for ttt, field in enumerate(fields):
+            self.cube[ttt] = field
+            if self.verbose:
+               print('binned', self.pdates[ttt][0], field.sum())
+        return self.cube
+
+    def model(self):
+        """returns a ModelBin (readwrite='w', see ModelBin._new) with self.cube on self.grid.
+           Set sourcedate, slat, slon and sht of the ModelBin for the release locations before writing it."""
+        from cdump import ModelBin
+        model = ModelBin('', cdir='', readwrite='w')
+        grid = self.grid
+        model.nlat = np.int32(grid[0])
+        model.nlon = np.int32(grid[1])
+        model.dlat = np.float32(grid[2])
+        model.dlon = np.float32(grid[3])
+        model.llcrnr_lat = np.float32(grid[4])
+        model.llcrnr_lon = np.float32(grid[5])
+        if self.pdates:
+           model.metdate = self.pdates[0][0]
+        model.levels = np.array(self.levels)
+        model.pollutants = list(self.species)
+        model.pdates = list(self.pdates)
+        model.cube = self.cube
+        model._cube_names()
+        return model
+
+    def write(self, filename, verbose=False):
+        """writes self.cube as a binary cdump file (see ModelBin.write). returns the file name."""
+        return self.model().write(filename, verbose=verbose)